@@ -0,0 +1,299 @@
+#!/usr/bin/python3
+#
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Benchmarks of wajig's hot paths, on synthetic package databases.
+
+For each scale, a fake root is generated in a temporary directory: a
+dpkg status database and file lists, APT package lists (with some
+packages upgradable, and some new), and .debs in the archive cache. The
+hot paths are then timed in a child process that has APT, dpkg, and
+wajig's own files pointed at that root, so no root access and no network
+are needed, and the host's own packages are left alone.
+
+    $ python3 bench.py
+    $ python3 bench.py --scale 5000 --repeat 5 --output before.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+SCALES = [5000, 50000, 200000]
+
+# run in order: update_unchanged needs the lists update_available cached,
+# count_upgrades what they write, and finish_log what start_log writes
+BENCHMARKS = ["update_available", "update_unchanged", "do_status",
+              "count_upgrades", "sizes", "dependents", "search",
+              "whichpackage", "listcache", "finish_log"]
+
+SECTIONS = ["admin", "devel", "doc", "libs", "net", "python", "utils", "x11"]
+
+
+def name(number):
+    return "{}{:06d}".format(("lib", "python3-", "", "x")[number % 4], number)
+
+
+def version(number, bump=0):
+    return "{}.{}.{}-{}".format(1 + number % 3, number % 17, number % 5,
+                                1 + bump)
+
+
+def stanza(number, bump=0, status=None):
+    """The control fields of synthetic package NUMBER."""
+    fields = [("Package", name(number))]
+    if status:
+        fields.append(("Status", status))
+    fields += [("Priority", "optional"),
+               ("Section", SECTIONS[number % len(SECTIONS)]),
+               ("Installed-Size", str(4 + number * 7919 % 50000)),
+               ("Maintainer", "Wajig Benchmarks <wajig@example.org>"),
+               ("Architecture", "amd64"),
+               ("Version", version(number, bump))]
+    if number > 10:
+        # on installed packages only, so that the system is consistent
+        depends = sorted({n - (n % 10 == 9)
+                          for n in (number // 2, number // 3, number - 7)})
+        fields.append(("Depends", ", ".join(name(n) for n in depends)))
+    if number % 7 == 0 and number:
+        fields.append(("Recommends", name(number - 2)))
+    if not status:
+        fields += [("Filename", "pool/main/{0}/{0}_{1}_amd64.deb"
+                    .format(name(number), version(number, bump))),
+                   ("Size", str(1000 + number % 9000))]
+    fields.append(("Description", "synthetic package number {}\n"
+                   " Generated by bench.py.".format(number)))
+    return "".join("{}: {}\n".format(*field) for field in fields) + "\n"
+
+
+def tar_member(tar, path, data):
+    info = tarfile.TarInfo(path)
+    info.size = len(data)
+    info.mtime = 0
+    tar.addfile(info, io.BytesIO(data))
+
+
+def ar_member(f, path, data):
+    f.write("{:<16}{:<12}{:<6}{:<6}{:<8}{:<10}`\n".format(
+            path, 0, 0, 0, 100644, len(data)).encode())
+    f.write(data)
+    if len(data) % 2:
+        f.write(b"\n")
+
+
+def write_deb(path, number, data):
+    """Write a .deb of synthetic package NUMBER, with DATA as data.tar.gz."""
+    control = io.BytesIO()
+    with tarfile.open(fileobj=control, mode="w:gz") as tar:
+        tar_member(tar, "./control", stanza(number).rstrip("\n").encode()
+                   + b"\n")
+    with open(path, "wb") as f:
+        f.write(b"!<arch>\n")
+        ar_member(f, "debian-binary", b"2.0\n")
+        ar_member(f, "control.tar.gz", control.getvalue())
+        ar_member(f, "data.tar.gz", data)
+
+
+def generate(root, scale, debs):
+    """Write the synthetic databases of SCALE packages under ROOT."""
+    rng = random.Random(scale)
+    for directory in ["var/lib/dpkg/info", "var/lib/dpkg/updates",
+                      "var/lib/apt/lists/partial", "var/cache/apt/archives",
+                      "etc/apt/apt.conf.d", "etc/apt/preferences.d",
+                      "etc/apt/sources.list.d", "home"]:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+    open(os.path.join(root, "var/lib/dpkg/available"), "w").close()
+    open(os.path.join(root, "var/lib/dpkg/diversions"), "w").close()
+    # installed: all but a tenth of the packages, a few only configured
+    installed = [n for n in range(scale) if n % 10 != 9]
+    with open(os.path.join(root, "var/lib/dpkg/status"), "w") as f:
+        for n in installed:
+            status = "deinstall ok config-files" if n % 50 == 3 else \
+                     "install ok installed"
+            f.write(stanza(n, status=status))
+    for n in installed:
+        files = ["/usr/share/doc/{}".format(name(n)),
+                 "/usr/share/doc/{}/copyright".format(name(n)),
+                 "/usr/share/doc/{}/changelog.Debian.gz".format(name(n))]
+        if n % 4 == 0:
+            files += ["/usr/lib/x86_64-linux-gnu/{}.so.{}".format(name(n),
+                                                                   n % 5)]
+        else:
+            files += ["/usr/bin/{}".format(name(n)),
+                      "/usr/share/man/man1/{}.1.gz".format(name(n))]
+        files += ["/usr/share/{}/data{}".format(name(n), i)
+                  for i in range(rng.randrange(6))]
+        with open(os.path.join(root, "var/lib/dpkg/info",
+                               name(n) + ".list"), "w") as f:
+            f.write("/.\n/usr\n/usr/share\n/usr/share/doc\n")
+            f.write("\n".join(files) + "\n")
+    # available: everything, a twentieth upgraded, plus a tenth more new
+    lists = os.path.join(root, "var/lib/apt/lists")
+    prefix = "bench_dists_stable_"
+    with open(os.path.join(lists, prefix + "Release"), "w") as f:
+        f.write("Origin: wajig\nLabel: wajig\nSuite: stable\n"
+                "Codename: stable\nArchitectures: amd64\nComponents: main\n"
+                "Date: Thu, 01 Jan 2026 00:00:00 UTC\n")
+    with open(os.path.join(lists, prefix + "main_binary-amd64_Packages"),
+              "w") as f:
+        for n in range(scale + scale // 10):
+            f.write(stanza(n, bump=int(n % 20 == 1)))
+    with open(os.path.join(root, "etc/apt/sources.list"), "w") as f:
+        f.write("deb [trusted=yes] http://bench/ stable main\n")
+    with open(os.path.join(root, "apt.conf"), "w") as f:
+        f.write('Dir "{0}/";\n'
+                'Dir::State::status "{0}/var/lib/dpkg/status";\n'
+                'Dir::Log "{0}/var/log/apt";\n'
+                'APT::Architecture "amd64";\n'
+                'APT::Architectures {{ "amd64"; }};\n'.format(root))
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w:gz") as tar:
+        tar_member(tar, "./usr/share/doc/bench/copyright", b"Public domain\n")
+    archives = os.path.join(root, "var/cache/apt/archives")
+    for n in range(0, scale, max(1, scale // debs) if debs else scale + 1):
+        write_deb(os.path.join(archives, "{}_{}_amd64.deb".format(
+                  name(n), version(n).replace(":", "%3a"))), n,
+                  data.getvalue())
+    return len(installed)
+
+
+@contextlib.contextmanager
+def silenced():
+    """Send what is written to stdout, by wajig or by commands it runs,
+    to /dev/null."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 1)
+    os.close(null)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def measure(root, scale, repeat):
+    """Time the BENCHMARKS against ROOT; runs in the child process."""
+    sys.path.insert(0, os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), "src"))
+    with silenced():
+        import util
+        import commands
+    util.dpkg_status = os.path.join(root, "var/lib/dpkg/status")
+    util.dpkg_info = os.path.join(root, "var/lib/dpkg/info")
+    util.archives_dir = os.path.join(root, "var/cache/apt/archives")
+    old_log = os.path.join(util.init_dir, "bench-old-log")
+    target = name(scale // 2 + 1)  # installed, with a file in /usr/bin
+    setups = {"update_available": lambda: shutil.rmtree(util.lists_cache,
+                                                       ignore_errors=True),
+              "finish_log": lambda: util.start_log(old_log)}
+    hot_paths = {
+        "update_available": lambda: util.update_available(noreport=True),
+        # after an 'apt-get update' that changed no list
+        "update_unchanged": lambda: util.update_available(noreport=True),
+        "do_status": lambda: util.do_status([]),
+        "count_upgrades": util.count_upgrades,
+        "sizes": util.sizes,
+        "dependents": lambda: commands.dependents(
+            argparse.Namespace(package=target)),
+        "search": lambda: commands.search(
+            argparse.Namespace(patterns=[target[:-2]], verbose=0)),
+        "whichpackage": lambda: commands.whichpackage(
+            argparse.Namespace(pattern="/usr/bin/" + target)),
+        # the .debs in the archive cache, against the installed versions
+        "listcache": lambda: commands.listcache(
+            argparse.Namespace(pattern=None)),
+        "finish_log": lambda: util.finish_log(old_log),
+    }
+    results = dict()
+    for benchmark in BENCHMARKS:
+        seconds = []
+        for i in range(repeat):
+            util.forget()  # time the cold path, as a fresh wajig run does
+            with silenced():
+                if benchmark in setups:
+                    setups[benchmark]()
+                begin = time.perf_counter()
+                hot_paths[benchmark]()
+                seconds.append(time.perf_counter() - begin)
+        seconds.sort()
+        results[benchmark] = {"min": seconds[0],
+                              "median": seconds[len(seconds) // 2],
+                              "max": seconds[-1], "runs": seconds}
+    return results
+
+
+def run(scale, repeat, debs, keep):
+    root = tempfile.mkdtemp(prefix="wajig-bench-{}-".format(scale))
+    try:
+        begin = time.perf_counter()
+        installed = generate(root, scale, debs)
+        generated = time.perf_counter() - begin
+        env = dict(os.environ, HOME=os.path.join(root, "home"),
+                   APT_CONFIG=os.path.join(root, "apt.conf"),
+                   DPKG_ADMINDIR=os.path.join(root, "var/lib/dpkg"))
+        # building the APT cache is setup, not something to time
+        subprocess.check_call(["apt-cache", "gencaches"], env=env,
+                              stdout=subprocess.DEVNULL)
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "--measure", root,
+             "--scale", str(scale), "--repeat", str(repeat)], env=env)
+        return {"packages": scale, "installed": installed,
+                "generate_seconds": generated,
+                "benchmarks": json.loads(output.decode())}
+    finally:
+        if keep:
+            print("Kept", root, file=sys.stderr)
+        else:
+            shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, nargs="+", default=SCALES,
+                        help="numbers of packages (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each benchmark (default: 3)")
+    parser.add_argument("--debs", type=int, default=1000,
+                        help=".debs in the archive cache (default: 1000)")
+    parser.add_argument("--output", default="bench.json",
+                        help="where to write the results (default: "
+                             "%(default)s)")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the generated roots, for a closer look")
+    parser.add_argument("--measure", metavar="ROOT", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.scale[0], args.repeat)))
+        return
+    results = {"python": platform.python_version(),
+               "machine": platform.machine(), "cpus": os.cpu_count(),
+               "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "scales": []}
+    for scale in args.scale:
+        result = run(scale, args.repeat, args.debs, args.keep)
+        results["scales"].append(result)
+        for benchmark in BENCHMARKS:
+            print("{:>7} {:<17} {:>9.3f}s".format(
+                  scale, benchmark,
+                  result["benchmarks"][benchmark]["median"]))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
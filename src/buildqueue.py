@@ -0,0 +1,221 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""A queue of source packages to build, several at a time.
+
+The sources are fetched concurrently, each into a directory of its own.
+Their debian/control files then tell which of them build-depend on a
+binary package that another one builds: such a package is only built
+once those it needs have been, and the .debs of them installed. As that
+changes the system the builds run on, it is only done while no build is
+running. The other build-dependencies are installed from the archive up
+front. Other builds run side by side, up to a number of jobs. What each
+step prints goes to a log per package, and each step is timed.
+
+The steps themselves are left to a Runner, so that the scheduling can be
+tried out with a runner that fakes them."""
+
+import concurrent.futures
+import os
+import shlex
+import subprocess
+import time
+
+import apt_pkg
+
+import perform
+import sourcegraph
+
+# downloads at a time; fetching is bound by the network, not the CPUs
+FETCHES = 4
+
+# what build-conflicts with a package, for 'apt-get satisfy'
+CONFLICTS = ["Build-Conflicts", "Build-Conflicts-Arch",
+             "Build-Conflicts-Indep"]
+
+
+def relations(field):
+    """The comma-separated relationships in FIELD of a control file."""
+    return [relation.strip() for relation in field.split(",")
+            if relation.strip()]
+
+
+class Build:
+    """A source package to build, in directory DIRECTORY, and how that
+    went: STATUS is None until it is known."""
+
+    def __init__(self, package, directory):
+        self.package = package
+        self.directory = directory
+        self.log = os.path.join(directory, "build.log")
+        self.source = None  # the unpacked source tree
+        self.binaries = set()
+        self.depends = set()  # names build-depended on
+        self.relations = list()  # each build-dependency, alternatives and all
+        self.conflicts = list()
+        self.after = list()  # the Builds to wait for
+        self.status = None
+        self.seconds = dict()  # {step: seconds it took}
+
+    def read_control(self):
+        """Find the unpacked source tree, and read from its control file
+        the binary packages it builds and what it build-depends on."""
+        for name in sorted(os.listdir(self.directory)):
+            control = os.path.join(self.directory, name, "debian", "control")
+            if os.path.exists(control):
+                self.source = os.path.dirname(os.path.dirname(control))
+                break
+        else:
+            return False
+        with open(control) as f:
+            sections = iter(apt_pkg.TagFile(f))
+            source = next(sections)
+            for field in sourcegraph.FIELDS:
+                self.depends.update(sourcegraph.names(source.get(field, "")))
+                self.relations += relations(source.get(field, ""))
+            for field in CONFLICTS:
+                self.conflicts += relations(source.get(field, ""))
+            self.binaries.update(section["Package"] for section in sections)
+        return True
+
+    def debs(self, names=None):
+        """The binary packages built (only those of NAMES), as paths."""
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if name.endswith(".deb") and
+                      (names is None or name.partition("_")[0] in names))
+
+
+class Runner:
+    """The steps of a build, as commands, each logged to the log of the
+    Build it is for."""
+
+    def __init__(self, noauth="", yes=""):
+        self.noauth = noauth
+        self.yes = yes
+
+    def command(self, build, argv, directory):
+        record = perform.Run(" ".join(argv))
+        if perform.TEACH:
+            print(perform.highlight("cd {} && {}".format(directory,
+                                                         " ".join(argv))))
+        with open(build.log, "a") as log:
+            log.write("$ {}\n".format(" ".join(argv)))
+            log.flush()
+            status = subprocess.call(argv, cwd=directory,
+                                     stdin=subprocess.DEVNULL, stdout=log,
+                                     stderr=subprocess.STDOUT)
+        return record.done(status)
+
+    def fetch(self, build):
+        """Download and unpack the source of BUILD; return the status."""
+        return self.command(build, ["apt-get"] + self.noauth.split() +
+                            ["source", build.package], build.directory)
+
+    def build(self, build):
+        return self.command(build, ["dpkg-buildpackage", "-b", "-uc", "-us"],
+                            build.source)
+
+    def satisfy(self, relations):
+        """Install from the archive what the dependency strings RELATIONS
+        ask for; return the status."""
+        command = "apt-get {} {} satisfy ".format(self.yes, self.noauth)
+        return perform.execute(command + " ".join(map(shlex.quote,
+                                                      relations)),
+                               root=True, log=True)
+
+    def install(self, debs):
+        """Install the .debs at paths DEBS, for a build needing them."""
+        return perform.execute("apt-get {} install ".format(self.yes) +
+                               " ".join(debs), root=True)
+
+
+class Queue:
+    """Source PACKAGES to fetch and build under directory WORKDIR, with
+    RUNNER, running at most JOBS builds at a time."""
+
+    def __init__(self, packages, workdir, runner, jobs=1):
+        self.builds = [Build(package, os.path.join(workdir, package))
+                       for package in dict.fromkeys(packages)]
+        self.runner = runner
+        self.jobs = max(1, jobs)
+
+    def step(self, build, name, action):
+        begin = time.monotonic()
+        status = action(build)
+        build.seconds[name] = time.monotonic() - begin
+        return status
+
+    def fetch(self):
+        """Fetch the sources, several at a time, then note which of the
+        builds each one must wait for."""
+        def fetch(build):
+            os.makedirs(build.directory, exist_ok=True)
+            if self.step(build, "fetch", self.runner.fetch) or \
+               not build.read_control():
+                build.status = "fetch failed"
+
+        with concurrent.futures.ThreadPoolExecutor(FETCHES) as executor:
+            list(executor.map(fetch, self.builds))
+        for build in self.builds:
+            build.after = [other for other in self.builds
+                           if other is not build and
+                           other.binaries & build.depends]
+
+    def archive_relations(self):
+        """The dependency strings to install from the archive before the
+        builds fetched can run: their build-dependencies (and conflicts),
+        without those the queue builds itself, as one string per build."""
+        fetched = [build for build in self.builds if build.status is None]
+        built = set().union(*(build.binaries for build in fetched))
+        # which 'apt-get build-dep' would install along with the rest
+        wanted = ["build-essential"] if fetched else []
+        for build in fetched:
+            kept = [relation for relation in build.relations
+                    if not built.intersection(sourcegraph.names(relation))]
+            if kept:
+                wanted.append(", ".join(kept))
+            if build.conflicts:
+                wanted.append("Conflicts: " + ", ".join(build.conflicts))
+        return wanted
+
+    def run(self):
+        """Build the packages that were fetched, each once those it waits
+        for are built, and return the Builds."""
+        pending = [build for build in self.builds if build.status is None]
+        running = dict()
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            while pending or running:
+                for build in list(pending):
+                    if any(other.status not in (None, "built")
+                           for other in build.after):
+                        build.status = "skipped"
+                        pending.remove(build)
+                    elif len(running) < self.jobs and \
+                         all(other.status == "built"
+                             for other in build.after):
+                        debs = [deb for other in build.after
+                                for deb in other.debs(build.depends)]
+                        if debs and running:
+                            # installing would change what the running
+                            # builds build with: let them end first, and
+                            # start no others meanwhile
+                            break
+                        pending.remove(build)
+                        if debs and self.runner.install(debs):
+                            build.status = "install failed"
+                            continue
+                        running[executor.submit(self.step, build, "build",
+                                                self.runner.build)] = build
+                if not running:
+                    # what is left waits on itself, in a cycle, or on a
+                    # build whose .debs could not be installed
+                    for build in pending:
+                        build.status = "skipped"
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    build = running.pop(future)
+                    failed = future.exception() or future.result()
+                    build.status = "build failed" if failed else "built"
+        return self.builds
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+#
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Pass read-only commands on to a running 'wajig daemon'.
+
+This is what the wajig script runs when the daemon's socket exists, so it
+only uses the standard library to start quickly. If the daemon does not
+answer, or the command is not one it serves, wajig.py is run instead."""
+
+import array
+import json
+import os
+import socket
+import sys
+
+# commands (and their aliases) that the daemon answers
+SERVED = set("""
+    status describe search dependents
+    whichpackage findfile find-file locate filesearch file-search whichpkg
+    which-package toupgrade newupgrades new-upgrades to-upgrade
+""".split())
+
+
+def socket_path():
+    """Location of the daemon's socket; see util.init_dir."""
+    init_dir = os.path.expanduser("~/.wajig/") + socket.gethostname()
+    return os.path.join(init_dir, "Daemon")
+
+
+def request(argv):
+    """Have the daemon run ARGV on our stdin, stdout, and stderr.
+
+    Returns the exit status, or None if the daemon could not be reached."""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path())
+    except OSError:
+        return None
+    message = json.dumps({"argv": argv, "cwd": os.getcwd(),
+                          "env": dict(os.environ)}) + "\n"
+    fds = array.array("i", [0, 1, 2])
+    with connection:
+        try:
+            connection.sendmsg([message.encode()],
+                               [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            reply = connection.makefile().readline()
+        except OSError:
+            return None
+    # an empty reply means the daemon went away while running the command
+    if not reply.strip():
+        return 1
+    try:
+        return int(reply)
+    except ValueError:
+        return None
+
+
+def main(argv):
+    if argv and argv[0] in SERVED:
+        status = request(argv)
+        if status is not None:
+            return status
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "wajig.py")
+    os.execv(sys.executable, [sys.executable, script] + argv)
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        pass
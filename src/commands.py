@@ -5,19 +5,27 @@
 # Do not include any function in here that does not correspond to a COMMAND
 
 import os
+import collections
+import re
 import sys
+import gzip
 import inspect
 import tempfile
-import subprocess
 import urllib.request
 import webbrowser
 
-import apt
-
 # wajig modules
 import perform
 import util
+import buildqueue
 import debfile
+import depgraph
+import history
+import hosts
+import latency
+import output
+import server
+import sourcegraph
 
 # before we do any other command make sure the right files exist
 util.ensure_initialised()
@@ -59,7 +67,7 @@ def autodownload(args):
     if not args.simulate:
         upgradable_packages = util.upgradable()
         if upgradable_packages:
-            util.do_describe(upgradable_packages, verbose)
+            util.do_describe(upgradable_packages, args.verbose)
         else:
             print("no upgradable packages")
         util.show_package_versions()
@@ -77,13 +85,51 @@ def autoremove(args):
 
 def build(args):
     """Get source packages, unpack them, and build binary packages from them.
-    This also installs the needed build-dependencies if needed."""
+    This also installs the needed build-dependencies if needed.
+
+    Each package is fetched into a directory of its own, named after it,
+    where its build.log and the .debs built end up; it must not be there
+    already. A package that build-depends on another one given is built
+    after it, once the .debs it needs are installed, which waits for the
+    builds running to end; the others are built side by side, --jobs at
+    a time (by default, one per CPU).
+
+    $ wajig build --jobs 4 libfoo foo-tools"""
     util.requires_package("sudo")
-    # First make sure dependencies are met
-    if not builddeps(args):
-        command = "apt-get {} source --build " + " ".join(args.packages)
-        command = command.format(args.noauth)
-        perform.execute(command)
+    if perform.SIMULATE:
+        builddeps(args)
+        for package in args.packages:
+            command = ("cd {0} && apt-get {1} source {0} && cd {0}-* && "
+                       "dpkg-buildpackage -b -uc -us").format(package,
+                                                              args.noauth)
+            print(perform.highlight(" ".join(command.split())))
+        return
+    queue = buildqueue.Queue(args.packages, os.getcwd(),
+                             buildqueue.Runner(args.noauth, args.yes),
+                             args.jobs)
+    in_the_way = [build.directory for build in queue.builds
+                  if os.path.exists(build.directory)]
+    for directory in in_the_way:
+        print("{} is in the way; move or remove it first".format(
+              os.path.relpath(directory)))
+    if in_the_way:
+        sys.exit(1)
+    queue.fetch()
+    relations = queue.archive_relations()
+    if relations and queue.runner.satisfy(relations):
+        sys.exit(1)
+    builds = queue.run()
+    print("{:<24} {:<14} {:>8} {:>8}  {}".format("Package", "Status",
+                                                 "Fetch", "Build", "Log"))
+    print("{}-{}-{}-{}--{}".format("="*24, "="*14, "="*8, "="*8, "="*20))
+    for build in builds:
+        print("{:<24} {:<14} {:>7.1f}s {:>7}  {}".format(
+              build.package, build.status, build.seconds["fetch"],
+              "{:.1f}s".format(build.seconds["build"])
+              if "build" in build.seconds else "-",
+              os.path.relpath(build.log)))
+    if any(build.status != "built" for build in builds):
+        sys.exit(1)
 
 
 def builddeps(args):
@@ -94,7 +140,11 @@ def builddeps(args):
 
 
 def changelog(args):
-    """Display Debian changelog of a package
+    """Display Debian changelog entries newer than the installed version
+
+    Without package names, this is done for all upgradable packages. The
+    changelog is read from the .deb in the download cache if it's there
+    already, otherwise it is retrieved from the network.
 
     network on:
          changelog - if there's newer entries, display them
@@ -106,46 +156,47 @@ def changelog(args):
       -v changelog - if there's newer entries, mention failure to retrieve, and
                      proceed to display complete local changelog"""
 
-    package = util.package_exists(apt.Cache(), args.package)
-    changelog = "{:=^79}\n".format(" {} ".format(args.package))  # header
-
-    try:
-        changelog += package.get_changelog()
-    except AttributeError as e:
-        # This is caught so as to avoid an ugly python-apt trace; it's a bug
-        # that surfaces when:
-        # 1. The package is not available in the default Debian suite
-        # 2. The suite the package belongs to is set to a pin of < 0
-        print("If this package is not on your default Debian suite, " \
-              "ensure that its APT pinning isn't less than 0.")
+    cache = util.session.cache
+    names = args.packages or util.upgradable()
+    if not names:
+        print("No upgradeable packages")
         return
-    help_message = "\nTo display the local changelog, run:\n" \
-                   "wajig changelog --verbose " + args.package
-    if "Failed to download the list of changes" in changelog:
-        if not args.verbose:
-            changelog += help_message
-        else:
-            changelog += "\n"
-    elif changelog.endswith("The list of changes is not available"):
-        changelog += ".\nYou are likely running the latest version.\n"
+    for name in names:
+        package = util.package_exists(cache, name)
+        print("{:=^79}".format(" {} ".format(name)))  # header
+        try:
+            lines = util.candidate_changelog(package)
+        except AttributeError as e:
+            # This is caught so as to avoid an ugly python-apt trace; it's a
+            # bug that surfaces when:
+            # 1. The package is not available in the default Debian suite
+            # 2. The suite the package belongs to is set to a pin of < 0
+            print("If this package is not on your default Debian suite, " \
+                  "ensure that its APT pinning isn't less than 0.")
+            continue
+        since = package.installed.version if package.is_installed else None
+        newer = False
+        text = ""
+        for version, entry in util.changelog_entries(lines, since):
+            newer = newer or version is not None
+            text = "".join(entry)
+            print(text, end="")
+        if not text:
+            print("You are likely running the latest version.")
+        elif not text.endswith("\n"):
+            print()
         if not args.verbose:
-            changelog += help_message
-    if not args.verbose:
-        print(changelog)
-    else:
-        tmp = tempfile.mkstemp()[1]
-        with open(tmp, "w") as f:
-            if package.is_installed:
-                changelog += "{:=^79}\n".format(" local changelog ")
-            f.write(changelog)
-        if package.is_installed:
-            command = util.local_changelog(args.package, tmp)
-            if not command:
-                return
-            perform.execute(command)
-        with open(tmp) as f:
-            for line in f:
-                print(line, end="")
+            if not newer:
+                print("\nTo display the local changelog, run:\n"
+                      "wajig changelog --verbose " + name)
+        elif package.is_installed:
+            path = util.local_changelog(name)
+            if not path:
+                continue
+            print("{:=^79}".format(" local changelog "))
+            with gzip.open(path, "rt", errors="replace") as f:
+                for line in f:
+                    print(line, end="")
 
 
 def clean(args):
@@ -165,6 +216,29 @@ def dailyupgrade(args):
                     root=True, log=True)
 
 
+def daemon(args):
+    """Start or stop a background service that answers queries quickly
+
+    The service keeps the APT cache, the dpkg status, and indexes derived
+    from them in memory, refreshing them whenever they change. While it
+    is running, these commands are passed on to it: status, describe,
+    search, dependents, whichpackage, and toupgrade.
+
+    $ wajig daemon start
+    $ wajig daemon status
+    $ wajig daemon stop"""
+    if args.action == "start":
+        server.start()
+    elif args.action == "stop":
+        server.stop()
+    else:
+        pid = server.running()
+        if pid:
+            print("wajig daemon is running (pid {})".format(pid))
+        else:
+            print("wajig daemon is not running")
+
+
 def dependents(args):
     """Display packages which have some form of dependency on the given package
 
@@ -175,29 +249,12 @@ def dependents(args):
     * Replaces
     * Enhances"""
 
-    DEPENDENCY_TYPES = [
-        "Depends",
-        "Recommends",
-        "Suggests",
-        "Replaces",
-        "Enhances",
-    ]
-
-    cache = apt.cache.Cache()
-    package = util.package_exists(cache, args.package)
-    dependents = { name : [] for name in DEPENDENCY_TYPES }
-
-    for key in cache.keys():
-        other_package = cache[key]
-        for dependency_type, specific_dependents in dependents.items():
-            if package.shortname in \
-            util.extract_dependencies(other_package, dependency_type):
-                specific_dependents.append(other_package.shortname)
-
-    for dependency_type, specific_dependents in dependents.items():
-        if specific_dependents:
-            output = dependency_type.upper(), " ".join(specific_dependents)
-            print("{}: {}".format(*output))
+    package = util.package_exists(util.session.cache, args.package)
+    for dependency_type in util.dependency_types:
+        dependents = util.reverse_dependencies(dependency_type)
+        if package.shortname in dependents:
+            output = dependency_type.upper(), dependents[package.shortname]
+            print("{}: {}".format(output[0], " ".join(output[1])))
 
 
 def describe(args):
@@ -279,6 +336,41 @@ def fixmissing(args):
     perform.execute(command, root=True, log=True)
 
 
+def fleet(args):
+    """Compare the packages installed across many hosts
+
+    Each file given (or found in a directory given) describes one host,
+    and is named after it: either a copy of its /var/lib/dpkg/status, or
+    the output of 'wajig snapshot' on it. Without options, a tab-separated
+    matrix of the installed version of every package on every host is
+    displayed.
+
+    $ wajig fleet collected/
+    $ wajig fleet --drift collected/
+    $ wajig fleet --missing openssl=3.0.11-1~deb12u2 collected/"""
+    fleet = hosts.read(args.files)
+    if args.missing:
+        for package, version in args.missing:
+            print("Hosts with {} older than {}:".format(package, version))
+            for host in hosts.missing(fleet, package, version):
+                print("    " + host)
+    elif args.drift:
+        for package, spread in hosts.drift(fleet):
+            print(package)
+            usual = max(spread, key=lambda version: len(spread[version]))
+            for version, names in sorted(spread.items(),
+                                         key=lambda item: -len(item[1])):
+                line = "    {:<32} {:>5} hosts".format(version or "-",
+                                                       len(names))
+                if version != usual:
+                    line += ": " + " ".join(names)
+                print(line)
+    else:
+        print("\t".join(["Package"] + sorted(fleet)))
+        for package, versions in hosts.matrix(fleet):
+            print("\t".join([package] + [v or "-" for v in versions]))
+
+
 def force(args):
     """Install packages and ignore file overwrites and depends
 
@@ -287,7 +379,7 @@ def force(args):
           whatever reason"""
 
     command = "/usr/bin/dpkg --install --force overwrite --force depends "
-    archives = "/var/cache/apt/archives/"
+    archives = util.archives_dir + "/"
 
     # For a .deb file we simply force install it.
     if args.packages[0].endswith(".deb"):
@@ -304,37 +396,34 @@ def force(args):
                 return()
     else:
         # Package names rather than a specific deb package archive
-        # is expected.
+        # is expected, possibly qualified by an architecture. Those not
+        # in the download archive yet are downloaded all at once, and
+        # the latest version of each is used.
+        index = util.archive_index()
+        missing = [package for package in args.packages
+                   if not util.archives_of(package, index)]
+        if missing:
+            dlcmd = "apt-get --quiet=2 --reinstall --download-only install "
+            dlcmd += " ".join("'" + package + "'" for package in missing)
+            perform.execute(dlcmd, root=True)
+            index = util.archive_index()
         for package in args.packages:
-            # Identify the latest version of the package available in
-            # the download archive, if there is any there.
-            lscmd = "ls " + archives
-            lscmd += " | grep -E '^" + package + "_' | sort -k 1b,1 | tail -n -1"
-            matches = perform.execute(lscmd, pipe=True)
-            debpkg = matches.readline().strip()
-
-            if not debpkg:
-                dlcmd = "apt-get --quiet=2 --reinstall --download-only "
-                dlcmd += "install '" + package + "'"
-                perform.execute(dlcmd, root=1)
-                matches = perform.execute(lscmd, pipe=True)
-                debpkg = matches.readline().strip()
-
-            # Force install the package from the download archive.
-            command += "'" + archives + debpkg + "' "
+            found = util.archives_of(package, index)
+            if not found:
+                print("No archive of {} found in {}.".format(package,
+                                                             archives))
+                return
+            command += "'" + found[-1].path + "' "
 
     perform.execute(command, root=True, log=True)
 
 
 def hold(args):
     """Place packages on hold (so they will not be upgraded)"""
-    for package in args.packages:
-        # The dpkg needs sudo but not the echo.
-        # Do all of it as root then!
-        command = "/bin/echo \"" + package + " hold\" | /usr/bin/dpkg --set-selections"
-        perform.execute(command, root=True)
+    util.set_selections(args.packages, "hold")
     print("The following packages are on hold:")
-    perform.execute("dpkg --get-selections | grep -E 'hold$' | cut -f1")
+    for selection in util.select(want="hold"):
+        print(selection.name)
 
 
 def info(args):
@@ -400,7 +489,7 @@ def install(args):
 
 def installsuggested(args):
     """Install a package and its Suggests dependencies"""
-    cache = apt.cache.Cache()
+    cache = util.session.cache
     package = util.package_exists(cache, args.package,
                                   ignore_virtual_packages=True)
     dependencies = list(util.extract_dependencies(package, "Suggests"))
@@ -433,27 +522,46 @@ def lastupdate(args):
 
 def listall(args):
     """List one line descriptions for all packages"""
-    command = ("apt-cache dumpavail |"
-               "grep -E \"^(Package|Description): \" |"
-               "awk '/^Package: /{pkg=$2} /^Description: /"
-               "{printf(\"%-24s %s\\n\", pkg,"
-               "substr($0,13))}' | sort -u -k 1b,1")
+    summaries = util.available_summaries()
     if args.pattern:
-        command = "{} | grep -E '{}'".format(command, args.pattern)
-    perform.execute(command)
-
+        search = re.compile(args.pattern).search
+        summaries = (summary for summary in summaries
+                     if search("{:<24} {}".format(*summary)))
+    if output.format:
+        return output.emit(["package", "summary"], summaries)
+    for summary in summaries:
+        print("{:<24} {}".format(*summary))
 
 
 def listcache(args):
-    """List the contents of the download cache"""
-    command = "printf 'Found %d files %s in the cache.\n\n'\
-           $(ls /var/cache/apt/archives/ | wc -l) \
-           $(ls -sh /var/cache/apt/archives/ | head -1 | awk '{print $2}')"
-    perform.execute(command)
-    command = "ls /var/cache/apt/archives/"
-    if args.pattern:
-        command = "{} | grep -E '{}'".format(command, args.pattern)
-    perform.execute(command)
+    """List the contents of the download cache
+
+    The archives are first summed up by what they are: of the installed
+    version of a package, newer than that (e.g. downloaded for an
+    upgrade), superseded by the installed version or by a newer archive,
+    or the newest archive of a package that is not installed (orphaned).
+    Only installed and newer archives are needed to install what is
+    installed now, so the rest can be reclaimed, e.g. with prunecache."""
+    categories = list(util.archive_categories())
+    files = collections.Counter()
+    sizes = collections.Counter()
+    for category, archive in categories:
+        files[category] += 1
+        sizes[category] += archive.size
+    print("Found {} files ({:.1f} MB) in the cache.\n".format(
+          len(categories), sum(sizes.values()) / 1000000))
+    print("{:<12} {:>7} {:>10}".format("Category", "Files", "MB"))
+    print("{}-{}-{}".format("="*12, "="*7, "="*10))
+    for category in util.ARCHIVE_CATEGORIES:
+        print("{:<12} {:>7} {:>10.1f}".format(category, files[category],
+                                             sizes[category] / 1000000))
+    reclaimable = sizes["superseded"] + sizes["orphaned"]
+    print("\n{:.1f} MB reclaimable.\n".format(reclaimable / 1000000))
+    search = re.compile(args.pattern).search if args.pattern else None
+    for category, archive in categories:
+        filename = os.path.basename(archive.path)
+        if not search or search(filename):
+            print(filename)
 
 
 def listalternatives(args):
@@ -497,15 +605,17 @@ def listfiles(args):
 
 def listhold(args):
     """List packages that are on hold (i.e. those that won't be upgraded)"""
-    perform.execute("dpkg --get-selections | grep -E 'hold$' | cut -f1")
+    for selection in util.select(want="hold"):
+        print(selection.name)
 
 
 def listinstalled(args):
     """List installed packages"""
-    command = "dpkg --get-selections | cut -f1"
-    if args.pattern:
-        command += " | grep -E '{}' | sort -k 1b,1".format(args.pattern)
-    perform.execute(command)
+    names = ((selection.name,) for selection in util.select(args.pattern))
+    if output.format:
+        return output.emit(["package"], names)
+    for name, in names:
+        print(name)
 
 
 def listlog(args):
@@ -520,10 +630,7 @@ def listnames(args):
 
 def listpackages(args):
     """List the status, version, and description of installed packages"""
-    command = "dpkg --list '*' | grep -E -v 'no description avail'"
-    if args.pattern:
-        command += " | grep -E '{}' | sort -k 1b,1".format(args.pattern)
-    perform.execute(command)
+    util.print_selections(util.select(args.pattern))
 
 
 def listscripts(args):
@@ -556,7 +663,7 @@ def listsection(args):
 
     note: Use the LISTSECTIONS command for a list of Debian Sections"""
     section = args.section
-    cache = apt.cache.Cache()
+    cache = util.session.cache
     for package in cache.keys():
         package = cache[package]
         if(package.section == args.section):
@@ -565,7 +672,7 @@ def listsection(args):
 
 def listsections(args):
     """List all available sections"""
-    cache = apt.cache.Cache()
+    cache = util.session.cache
     sections = list()
     for package in cache.keys():
         package = cache[package]
@@ -577,12 +684,8 @@ def listsections(args):
 
 def liststatus(args):
     """Same as list but only prints first two columns, not truncated"""
-    command = "COLUMNS=400 "
-    command += "dpkg --list '*' | grep -E -v 'no description avail'"
-    command += " | awk '{print $1,$2}'"
-    if args.pattern:
-        command += " | grep -E '{}' | sort -k 1b,1".format(args.pattern)
-    perform.execute(command)
+    for selection in util.select(args.pattern):
+        print(util.selection_flags(selection).rstrip(), selection.name)
 
 
 def localdistupgrade(args):
@@ -604,14 +707,82 @@ def madison(args):
     perform.execute(command)
 
 
+def metrics(args):
+    """Summarize how long each wajig command took over time
+
+    Every run of wajig notes the command, how long it took, how many
+    packages dpkg changed, how many bytes were downloaded, and the exit
+    status. The median (p50) and 95th percentile (p95) times are shown
+    per command, and with --textfile they are written, with the other
+    figures, for the textfile collector of the Prometheus node_exporter.
+
+    $ wajig metrics
+    $ wajig metrics update upgrade
+    $ wajig metrics --textfile /var/lib/node_exporter/wajig.prom"""
+    summaries = latency.summarize(latency.read())
+    if args.commands:
+        summaries = {command: summary
+                     for command, summary in summaries.items()
+                     if command in args.commands}
+    if args.textfile:
+        latency.write_textfile(summaries, args.textfile)
+        return
+    if not summaries:
+        print("No runs of wajig recorded yet")
+        return
+    print("{:<20} {:>6} {:>8} {:>8} {:>8} {:>6} {:>8} {:>10}".format(
+          "Command", "Runs", "p50", "p95", "Max", "Failed", "Changed",
+          "MB fetched"))
+    print("{}-{}-{}-{}-{}-{}-{}-{}".format("="*20, "="*6, "="*8, "="*8, "="*8,
+                                           "="*6, "="*8, "="*10))
+    for command in sorted(summaries):
+        summary = summaries[command]
+        print("{:<20} {:>6} {:>8.2f} {:>8.2f} {:>8.2f} {:>6} {:>8} {:>10.1f}"
+              .format(command, summary.runs, summary.p50, summary.p95,
+                      summary.max, summary.failures, summary.changed,
+                      summary.downloaded / 1000000))
+
+
 def move(args):
     """Move packages in the download cache to a local Debian mirror (apt-move)"""
     perform.execute("/usr/bin/apt-move update", root=True)
 
 
 def new(args):
-    """Display newly-available packages"""
-    util.newly_available(args.verbose)
+    """Display newly-available packages
+
+    After a big update there can be thousands of them; --limit shows that
+    many at a time, and --page which of those pages to show.
+
+    With --changes, every change the last update brought is shown instead,
+    with the previous and available versions: packages that are new,
+    removed, upgraded, or downgraded (or only the kinds given).
+
+    Every update is also noted in a history of the available packages, so
+    --since shows what is new (or, with --changes, what changed) since a
+    date instead, and --history when each version of a package became
+    available.
+
+    $ wajig new --verbose --limit 20 --page 2
+    $ wajig new --changes removed upgraded
+    $ wajig new --since 2026-09-01
+    $ wajig new --history bash"""
+    if args.since is not None and not args.history:
+        start = history.start(util.history_file)
+        if start is None:
+            print("There is no history of available packages yet; "
+                  "it starts with the next update")
+            sys.exit(1)
+        if start > args.since:
+            print("The history of available packages starts on " +
+                  history.show_time(start))
+            sys.exit(1)
+    if args.history:
+        util.show_history(args.history)
+    elif args.changes is not None:
+        util.show_delta(args.changes, args.since)
+    else:
+        util.newly_available(args.verbose, args.limit, args.page, args.since)
 
 
 def newdetail(args):
@@ -633,9 +804,19 @@ def nonfree(args):
 
 
 def orphans(args):
-    """List libraries not required by any installed package """
-    util.requires_package("deborphan")
-    perform.execute("deborphan")
+    """List libraries not required by any installed package
+
+    A package is orphaned when no installed package depends on it, or
+    recommends or suggests it, whether by its name or by a name it
+    provides. Only libraries (the libs and oldlibs sections) are looked
+    at, unless other sections are asked for.
+
+    $ wajig orphans
+    $ wajig orphans --section libdevel --ignore Suggests
+    $ wajig orphans --all-sections"""
+    graph = depgraph.Graph(util.status_sections())
+    for package in graph.orphans(depgraph.rules(args)):
+        print(package.name)
 
 
 def policy(args):
@@ -643,6 +824,27 @@ def policy(args):
     perform.execute("apt-cache policy " + " ".join(args.packages))
 
 
+def prunecache(args):
+    """Remove all but the newest versions of each package from the cache
+
+    Unlike autoclean, archives that can no longer be downloaded are kept,
+    as long as they are among the newest KEEP (by default 1) versions of
+    their package, so a cache stays bounded without losing the versions
+    one might want to go back to.
+
+    $ wajig prunecache --keep 2"""
+    index = util.archive_index()
+    prunable = util.prunable_archives(index, args.keep)
+    if not prunable:
+        print("No archives to prune")
+        return
+    command = "rm -f " + " ".join(archive.path for archive in prunable)
+    if perform.execute(command, root=True) == 0:
+        print("Removed {} archives, freeing {:.1f} MB".format(
+              len(prunable), sum(archive.size for archive in prunable)
+              / 1000000))
+
+
 def purge(args):
     """Remove one or more packages and their configuration files"""
     packages = util.consolidate_package_names(args)
@@ -654,12 +856,9 @@ def purge(args):
 
 def purgeorphans(args):
     """Purge orphaned libraries (not required by installed packages)"""
-    # Deborphans does not require root, but dpkg does,
-    # so build up the orphans list first, then pass that to dpkg.
-    util.requires_package("deborphan")
-    packages = ""
-    for package in perform.execute("deborphan", pipe=True):
-        packages += " " + package.strip()
+    graph = depgraph.Graph(util.status_sections())
+    packages = "".join(" " + package.name
+                       for package in graph.orphans(depgraph.rules(args)))
     if packages:
         command = "/usr/bin/apt-get --auto-remove purge {} {}"
         command = command.format(args.yes, packages)
@@ -668,23 +867,40 @@ def purgeorphans(args):
 
 def purgeremoved(args):
     """Purge all packages marked as deinstall"""
-    packages = ""
-    cmd = ("dpkg-query --show --showformat='${Package}\t${Status}\n' | "
-           "grep -E \"deinstall ok config-files\" | cut -f 1 ")
-    packages = perform.execute(cmd, pipe=True)
+    packages = [selection.name for selection in
+                util.select(want="deinstall", status="config-files")]
     if packages:
-        packages = " ".join(packages)
-        packages = " ".join(packages.split())
-        perform.execute("/usr/bin/apt-get purge " + packages,
+        perform.execute("/usr/bin/apt-get purge " + " ".join(packages),
                         root=True, log=True)
 
 
 def rbuilddeps(args):
-    """Display the packages which build-depend on the given package"""
-    util.requires_package("grep-dctrl")
-    command = "grep-available -sPackage -FBuild-Depends,Build-Depends-Indep "
-    command = command + args.package + " /var/lib/apt/lists/*Sources"
-    perform.execute(command)
+    """Display the packages which build-depend on the given package
+
+    These are source packages, from the Sources lists that deb-src lines
+    in the sources bring in. With --transitive, all the source packages
+    to rebuild when the package changes are shown, with the round of
+    rebuilds each belongs to: those of round 2 build-depend on a package
+    built by one of round 1, and so on.
+
+    $ wajig rbuilddeps libssl-dev --transitive"""
+    graph = sourcegraph.Graph(util.sources_cache)
+    if not graph.lists:
+        print("No source package lists; add deb-src lines to the sources, "
+              "then update")
+        sys.exit(1)
+    if args.transitive:
+        rebuilds = graph.rebuilds(args.package)
+        if output.format:
+            return output.emit(["source", "round"], rebuilds)
+        for source, depth in rebuilds:
+            print("{:<5} {}".format(depth, source))
+    else:
+        sources = ((source,) for source in graph.rdepends(args.package))
+        if output.format:
+            return output.emit(["source"], sources)
+        for source, in sources:
+            print(source)
 
 
 def readme(args):
@@ -697,7 +913,7 @@ def recdownload(args):
 
     package_names = list()
 
-    cache = apt.cache.Cache()
+    cache = util.session.cache
     for package in args.packages:
         util.package_exists(cache, package)
 
@@ -723,11 +939,27 @@ def reconfigure(args):
 
 
 def recommended(args):
-    """Display packages installed as Recommends and have no dependents"""
-    command = ("aptitude search '"
-              "?and( ?automatic(?reverse-recommends(?installed)), "
-              "?not(?automatic(?reverse-depends(?installed))) )'")
-    perform.execute(command)
+    """Display packages installed as Recommends and have no dependents
+
+    These are packages installed automatically, that some installed
+    package recommends, but that none depends on. Next to the size of
+    each is how much removing it would free, counting the automatically
+    installed packages that would go with it."""
+    graph = depgraph.Graph(util.status_sections())
+    auto = depgraph.read_auto()
+    packages = graph.recommended(auto)
+    if not packages:
+        print("No packages are installed only as recommended")
+        return
+    print("{:<33} {:>10} {:>16}".format("Package", "Size (KB)",
+                                        "Reclaimable (KB)"))
+    print("{}-{}-{}".format("="*33, "="*10, "="*16))
+    for package in packages:
+        reclaimable = sum(removed.installed_size for removed in
+                          graph.reclaimable(package.name, auto))
+        print("{:<33} {:>10,d} {:>16,d}".format(package.name,
+                                                package.installed_size,
+                                                reclaimable))
 
 
 def reinstall(args):
@@ -756,10 +988,9 @@ def remove(args):
 
 def removeorphans(args):
     """Remove orphaned libraries"""
-    util.requires_package("deborphan")
-    packages = ""
-    for package in perform.execute("deborphan", pipe=True):
-        packages += " " + package.strip()
+    graph = depgraph.Graph(util.status_sections())
+    packages = "".join(" " + package.name
+                       for package in graph.orphans(depgraph.rules(args)))
     if packages:
         command = "/usr/bin/apt-get --auto-remove remove {} {}"
         command = command.format(args.yes, packages)
@@ -813,17 +1044,13 @@ def search(args):
         command = 'debtags search ' + args.patterns[0]
         if args.verbose:
             command += ' --full'
-    elif not args.verbose:
-        command = "apt-cache --names-only search {}"
-        command = command.format(" ".join(args.patterns))
-    elif args.verbose == 1:
-        import shlex
-        args.patterns = [shlex.quote(pattern) for pattern in args.patterns]
-        command = "apt-cache search {} | grep -E --ignore-case '{}'"
-        command = command.format(" ".join(args.patterns),
-                                 "\|".join(args.patterns))
-    else:
+    elif args.verbose and args.verbose > 1:
         command = "apt-cache search --full " + " ".join(args.patterns)
+    else:
+        for name, summary in util.search_packages(args.patterns,
+                                                  bool(args.verbose)):
+            print("{} - {}".format(name, summary))
+        return
     perform.execute(command)
 
 
@@ -864,8 +1091,60 @@ def sizes(args):
 
 
 def snapshot(args):
-    """Generates a list of package=version for all installed packages"""
-    util.do_status([], snapshot=True)
+    """Generates a list of package=version for all installed packages
+
+    The list can be compared with another one using SNAPSHOT-DIFF, and
+    the system can be brought back to it using RESTORE.
+
+    $ wajig snapshot > snapshot.txt"""
+    versions = util.installed_instances()
+    if output.format:
+        return output.emit(["package", "version"],
+                           ((package, versions[package])
+                            for package in sorted(versions)))
+    hosts.write_snapshot(versions, sys.stdout)
+
+
+def snapshotdiff(args):
+    """Compare two snapshots, or a snapshot with the installed packages
+
+    For each package that differs, this shows what it would take to go
+    from the first to the second: install, remove, upgrade, or downgrade.
+
+    $ wajig snapshot-diff old.txt new.txt
+    $ wajig snapshot-diff old.txt          (compare with this system)"""
+    old = hosts.read_snapshot(args.old)
+    if args.new:
+        new = hosts.read_snapshot(args.new)
+    else:
+        new = util.installed_instances()
+    for package, before, after, change in util.version_changes(old, new):
+        print("{:<10} {:<32} {:<20} {}".format(change, package,
+                                               before or "-", after or "-"))
+
+
+def restore(args):
+    """Bring installed packages back to what they were in a snapshot
+
+    This installs, removes, upgrades and downgrades packages as needed to
+    match the snapshot, all in a single apt-get run. The versions needed
+    must of course be available from the archive (or download cache)."""
+    plan = list(util.version_changes(util.installed_instances(),
+                           hosts.read_snapshot(args.snapshot)))
+    if not plan:
+        print("Installed packages already match the snapshot")
+        return
+    targets = list()
+    for package, before, after, change in plan:
+        if change == "remove":
+            targets.append(package + "-")
+        else:
+            targets.append("{}={}".format(package, after))
+    command = "/usr/bin/apt-get {} {} {} install "
+    downgrade = any(change == "downgrade" for *rest, change in plan)
+    command = command.format(args.yes, args.noauth,
+                             "--allow-downgrades" if downgrade else "")
+    perform.execute(command + " ".join(targets), root=True, log=True)
 
 
 def source(args):
@@ -903,7 +1182,7 @@ def todo(args):
 
 def toupgrade(args):
     """List versions of upgradable packages"""
-    if not util.show_package_versions():
+    if not util.show_package_versions() and not output.format:
         print("No upgradeable packages")
 
 def tutorial(args):
@@ -917,13 +1196,10 @@ def tutorial(args):
 
 def unhold(args):
     """Remove listed packages from hold so they are again upgradeable"""
-    for package in args.packages:
-        # The dpkg needs sudo but not the echo.
-        # Do all of it as root then.
-        command = "echo \"" + package + " install\" | dpkg --set-selections"
-        perform.execute(command, root=1)
+    util.set_selections(args.packages, "install")
     print("The following packages are still on hold:")
-    perform.execute("dpkg --get-selections | grep -E 'hold$' | cut -f1")
+    for selection in util.select(want="hold"):
+        print(selection.name)
 
 
 def unofficial(args):
@@ -981,6 +1257,23 @@ def upgrade(args):
         print('No upgradeable packages. Did you run "wajig update" first?')
 
 
+def upgradenews(args):
+    """Display new NEWS.Debian entries of downloaded pending upgrades
+
+    Run this after 'wajig autodownload' (or any download-only upgrade) to
+    review important changes before going through with the upgrade. Only
+    entries newer than the installed version are shown."""
+    packages = util.upgradable(distupgrade=True, get_names_only=False)
+    found = False
+    for name, entries in util.pending_news(sorted(packages)):
+        found = True
+        print("{:=^79}".format(" {} ".format(name)))
+        for entry in entries:
+            print("".join(entry), end="")
+    if not found:
+        print("No news for the downloaded upgrades")
+
+
 def upgradesecurity(args):
     """Do a security upgrade"""
     sources_list = tempfile.mkstemp(".security", "wajig.", "/tmp")[1]
@@ -1020,14 +1313,13 @@ def whichpackage(args):
     """Search for files matching a given pattern within packages
 
     Note: if no match is found, the apt-file repository is checked"""
-    try:
-        out = perform.execute("dpkg --search " + args.pattern, getoutput=True)
-    except subprocess.CalledProcessError:
+    found = False
+    for packages, path, diversion in util.search_files(args.pattern):
+        found = True
+        if diversion:
+            print("\n".join(util.show_diversion(diversion)))
+        if packages:
+            print("{}: {}".format(", ".join(packages), path))
+    if not found:
         util.requires_package("apt-file")
         perform.execute("apt-file search " + args.pattern)
-    else:
-        try:
-            print(out.decode().strip())
-        # will get here when on --simulate mode
-        except AttributeError:
-            pass
@@ -0,0 +1,181 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""The dependency graph of the installed packages, and its orphans.
+
+The graph is read from the dpkg status database in a single pass: for
+each kind of relationship, the names that some installed package asks
+for (directly, or as one of several alternatives) are collected. A
+package is orphaned when neither its name nor any name it provides is
+asked for, under the relationships the rules count. As with deborphan,
+only libraries are looked at by default, and Recommends and Suggests
+keep a package installed just as Depends do.
+
+With the auto-installed flags of APT's extended states, the graph also
+tells which packages are only installed because they were recommended,
+and how much removing one would free, counting what else APT would then
+remove automatically."""
+
+import collections
+import fnmatch
+
+import apt_pkg
+
+import util
+
+# relationships that can keep a package installed
+RELATIONSHIPS = ["Pre-Depends", "Depends", "Recommends", "Suggests"]
+
+# those that keep an automatically installed package installed, as APT's
+# autoremove sees it (APT::AutoRemove::RecommendsImportant is the default)
+DEPENDS = ["Pre-Depends", "Depends"]
+IMPORTANT = DEPENDS + ["Recommends"]
+
+Package = collections.namedtuple("Package", "name section priority essential "
+                                            "provides installed_size")
+
+Rules = collections.namedtuple("Rules", "sections relationships")
+
+# deborphan's defaults
+DEFAULT_SECTIONS = ["libs", "oldlibs"]
+DEFAULT_RULES = Rules(DEFAULT_SECTIONS, RELATIONSHIPS)
+
+
+def names(field):
+    """The package names in a relationship FIELD, alternatives included."""
+    return [name for group in apt_pkg.parse_depends(field)
+            for name, version, operator in group]
+
+
+def read_auto(path=None):
+    """Names of the packages flagged as automatically installed in APT's
+    extended states, with the architecture of those that are foreign."""
+    if path is None:
+        path = apt_pkg.config.find_file("Dir::State::extended_states")
+    native = apt_pkg.config.find("APT::Architecture")
+    auto = set()
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return auto
+    with f:
+        for section in apt_pkg.TagFile(f):
+            if section.get("Auto-Installed") == "1":
+                auto.add(util.qualified_name(section, native, same=False))
+    return auto
+
+
+class Graph:
+    """Installed packages, and who asks for which names by each kind of
+    relationship.
+
+    Packages are keyed by their names as dpkg shows them, with the
+    architecture when several may be installed, as util.read_selections()
+    names them; relationships name packages without it."""
+
+    def __init__(self, sections):
+        """Read the SECTIONS of a dpkg status database; see
+        util.read_status()."""
+        native = apt_pkg.config.find("APT::Architecture")
+        self.packages = dict()
+        # {relationship: {name asked for: packages asking}}
+        self.wanted = {relationship: collections.defaultdict(set)
+                       for relationship in RELATIONSHIPS}
+        # {package: names it asks for by an important relationship}
+        self.important = dict()
+        # {name: installed packages of that name, or providing it}
+        self.providers = collections.defaultdict(list)
+        # {package: its name as APT shows it, e.g. in extended states}
+        self.apt_names = dict()
+        for section in sections:
+            if not section.get("Status", "").endswith(" installed"):
+                continue
+            name = util.qualified_name(section, native)
+            package = self.packages[name] = Package(
+                name, section.get("Section", ""),
+                section.get("Priority", ""),
+                section.get("Essential") == "yes",
+                names(section.get("Provides", "")),
+                int(section.get("Installed-Size", "0")))
+            self.apt_names[name] = util.qualified_name(section, native,
+                                                       same=False)
+            for provided in [section["Package"]] + package.provides:
+                self.providers[provided].append(name)
+            self.important[name] = list()
+            for relationship in RELATIONSHIPS:
+                if relationship in section:
+                    asked = names(section[relationship])
+                    for wanted in asked:
+                        self.wanted[relationship][wanted].add(name)
+                    if relationship in IMPORTANT:
+                        self.important[name] += asked
+
+    def answers(self, name):
+        """The names package NAME answers to: its own, and those it
+        provides."""
+        return [name.partition(":")[0]] + self.packages[name].provides
+
+    def askers(self, name, relationships):
+        """Packages asking for package NAME, or for a name it provides, by
+        any of RELATIONSHIPS."""
+        asking = set()
+        for wanted in self.answers(name):
+            for relationship in relationships:
+                asking.update(self.wanted[relationship].get(wanted, ()))
+        asking.discard(name)
+        return asking
+
+    def orphans(self, rules=DEFAULT_RULES):
+        """Return the sorted orphaned Packages, by RULES."""
+        wanted = set().union(*(self.wanted[relationship].keys()
+                               for relationship in rules.relationships))
+        orphaned = list()
+        for name in sorted(self.packages):
+            package = self.packages[name]
+            if package.essential or package.priority == "required":
+                continue
+            if rules.sections is not None:
+                section = package.section.rpartition("/")[2]
+                if not any(fnmatch.fnmatchcase(section, pattern)
+                           for pattern in rules.sections):
+                    continue
+            if wanted.intersection(self.answers(name)):
+                continue
+            orphaned.append(package)
+        return orphaned
+
+    def recommended(self, auto):
+        """Return the sorted Packages that were installed automatically
+        (their names are in AUTO) because an installed package recommends
+        them, and that no installed package depends on."""
+        return [self.packages[name] for name in sorted(self.packages)
+                if self.apt_names[name] in auto and
+                self.askers(name, ["Recommends"]) and
+                not self.askers(name, DEPENDS)]
+
+    def reclaimable(self, name, auto):
+        """Return the packages that removing package NAME would remove:
+        NAME itself, and the automatically installed packages (in AUTO)
+        that would then be left without an important reason to stay."""
+        removed = {name}
+        pending = [name]
+        while pending:
+            for wanted in self.important[pending.pop()]:
+                for candidate in self.providers.get(wanted, []):
+                    if candidate in removed or \
+                       self.apt_names[candidate] not in auto:
+                        continue
+                    if self.askers(candidate, IMPORTANT) <= removed:
+                        removed.add(candidate)
+                        pending.append(candidate)
+        return [self.packages[package] for package in sorted(removed)]
+
+
+def rules(args):
+    """The Rules asked for by the options of an orphans command."""
+    if args.all_sections:
+        sections = None
+    else:
+        sections = DEFAULT_SECTIONS + (args.section or [])
+    ignored = set(args.ignore or [])
+    return Rules(sections, [relationship for relationship in RELATIONSHIPS
+                            if relationship not in ignored])
@@ -0,0 +1,149 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""The history of the available packages, across updates.
+
+Each update appends to a single file what it changed in the available
+packages: the versions that appeared, and the packages that went away.
+Every so often (every CHECKPOINT_EVERY updates, or sooner when the
+changes since the last one add up to more than the whole table) the
+whole table is written instead, as a checkpoint. The table at any time
+is then rebuilt by replaying the changes after the checkpoint before
+that time. A small index, also only appended to, notes where each entry
+starts, so that nothing before that checkpoint is read."""
+
+import collections
+import time
+
+CHECKPOINT_EVERY = 50
+
+Entry = collections.namedtuple("Entry", "time offset kind size")
+
+
+def date(text):
+    """The time (seconds since the epoch) of a date given as YYYY-MM-DD,
+    maybe followed by HH:MM, in local time."""
+    for layout in ["%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return int(time.mktime(time.strptime(text, layout)))
+        except ValueError:
+            pass
+    raise ValueError(text)
+
+
+def show_time(seconds):
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(seconds))
+
+
+def read_index(path):
+    """Return the Entries of the history file at PATH, oldest first."""
+    entries = list()
+    try:
+        with open(path + ".index") as f:
+            for line in f:
+                seconds, offset, kind, size = line.split()
+                entries.append(Entry(int(seconds), int(offset), kind,
+                                     int(size)))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def record(previous, available, path, when=None):
+    """Append to the history file at PATH how the available packages went
+    from PREVIOUS to AVAILABLE, both {package: version}, at time WHEN (by
+    default now). Nothing is written when nothing changed."""
+    when = int(time.time() if when is None else when)
+    entries = read_index(path)
+    changes = [(package, version) for package, version in available.items()
+               if previous.get(package) != version]
+    changes += [(package, None) for package in previous
+                if package not in available]
+    if entries and not changes:
+        return
+    checkpoints = [i for i, entry in enumerate(entries)
+                   if entry.kind == "checkpoint"]
+    since = entries[checkpoints[-1] + 1:] if checkpoints else entries
+    if not checkpoints or len(since) + 1 >= CHECKPOINT_EVERY or \
+       sum(entry.size for entry in since) + len(changes) > len(available):
+        kind, changes = "checkpoint", sorted(available.items())
+    else:
+        kind = "delta"
+        changes.sort()
+    with open(path, "a") as f:
+        offset = f.tell()
+        f.write("{} {}\n".format(kind, when))
+        for package, version in changes:
+            if version is None:
+                f.write("- {}\n".format(package))
+            else:
+                f.write("+ {} {}\n".format(package, version))
+    with open(path + ".index", "a") as f:
+        f.write("{} {} {} {}\n".format(when, offset, kind, len(changes)))
+
+
+def start(path):
+    """Return the time the history at PATH starts, or None if it has not
+    started yet."""
+    for entry in read_index(path):
+        if entry.kind == "checkpoint":
+            return entry.time
+    return None
+
+
+def table_at(when, path):
+    """Return {package: version} of the packages available at time WHEN,
+    or None if the history at PATH starts later."""
+    entries = read_index(path)
+    start = None
+    for entry in entries:
+        if entry.time > when:
+            break
+        if entry.kind == "checkpoint":
+            start = entry
+    if start is None:
+        return None
+    table = dict()
+    with open(path) as f:
+        f.seek(start.offset)
+        for line in f:
+            fields = line.split()
+            if fields[0] == "+":
+                table[fields[1]] = fields[2]
+            elif fields[0] == "-":
+                table.pop(fields[1], None)
+            elif int(fields[1]) > when:
+                break
+            elif fields[0] == "checkpoint":
+                table.clear()
+    return table
+
+
+def versions(package, path):
+    """Yield (time, version) for each time the version of PACKAGE that is
+    available changed, in the history at PATH; VERSION is None when it
+    went away."""
+    current = None
+    seconds = checkpoint = None
+    seen = False
+    try:
+        f = open(path)
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ("checkpoint", "delta"):
+                if checkpoint and not seen and current is not None:
+                    current = None
+                    yield seconds, None
+                seconds = int(fields[1])
+                checkpoint = fields[0] == "checkpoint"
+                seen = False
+            elif fields[1] == package:
+                seen = True
+                version = fields[2] if fields[0] == "+" else None
+                if version != current:
+                    current = version
+                    yield seconds, version
+        if checkpoint and not seen and current is not None:
+            yield seconds, None
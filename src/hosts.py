@@ -0,0 +1,116 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Snapshots of installed packages, and comparisons between hosts.
+
+A host is described by one file, named after the host: either a copy
+of its dpkg status database, or a snapshot taken on it with 'wajig
+snapshot'. When there are many, the files are parsed in parallel, one
+process per CPU, so hundreds of hosts are dealt with in seconds."""
+
+import collections
+import concurrent.futures
+import os
+
+import apt_pkg
+
+import util
+
+# stripped from file names to get the host name
+SUFFIXES = (".status", ".snapshot", ".txt")
+
+
+def host_name(path):
+    name = os.path.basename(path)
+    for suffix in SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+# first line of snapshot files, to tell the format apart from later ones
+SNAPSHOT_HEADER = "# wajig snapshot 1\n"
+
+
+def write_snapshot(versions, f):
+    """Write {package: version} to F, as sorted package=version lines."""
+    f.write(SNAPSHOT_HEADER)
+    f.writelines("{}={}\n".format(package, versions[package])
+                 for package in sorted(versions))
+
+
+def read_snapshot(path):
+    """Return {package: version} from a snapshot file.
+
+    Lines starting with '#' are skipped, so the output of 'wajig snapshot'
+    from before snapshots had a header is read just as well."""
+    versions = dict()
+    with open(path) as f:
+        for line in f:
+            if "=" in line and not line.startswith("#"):
+                package, version = line.strip().split("=", 1)
+                versions[package] = version
+    return versions
+
+
+def read_host(path):
+    """Return (host, {package: version}) of what's installed on a host."""
+    with open(path) as f:
+        first = f.readline()
+    if first.startswith("Package:"):
+        versions = util.installed_instances(util.read_status(path))
+    else:
+        versions = read_snapshot(path)
+    return host_name(path), versions
+
+
+def read(paths):
+    """Return {host: {package: version}} for the given files (or
+    directories of files), parsing them in parallel."""
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, name)
+                                for name in os.listdir(path)))
+        else:
+            files.append(path)
+    workers = os.cpu_count() or 1
+    chunksize = max(1, len(files) // (workers * 4))
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        return dict(pool.map(read_host, files, chunksize=chunksize))
+
+
+def matrix(hosts):
+    """Yield (package, [version per host]) for all packages, in order,
+    with None where a host doesn't have the package installed."""
+    names = sorted(hosts)
+    packages = set()
+    for versions in hosts.values():
+        packages.update(versions)
+    for package in sorted(packages):
+        yield package, [hosts[host].get(package) for host in names]
+
+
+def drift(hosts):
+    """Yield (package, {version: [hosts]}) for the packages that are not
+    at the same version everywhere; None stands for 'not installed'."""
+    for package, versions in matrix(hosts):
+        if len(set(versions)) > 1:
+            spread = collections.defaultdict(list)
+            for host, version in zip(sorted(hosts), versions):
+                spread[version].append(host)
+            yield package, spread
+
+
+def requirement(text):
+    """The (package, version) of a requirement given as PACKAGE=VERSION."""
+    package, equals, version = text.partition("=")
+    if not package or not version:
+        raise ValueError(text)
+    return package, version
+
+
+def missing(hosts, package, version):
+    """Return the hosts where PACKAGE is installed, but older than VERSION."""
+    return [host for host in sorted(hosts)
+            if package in hosts[host] and
+               apt_pkg.version_compare(hosts[host][package], version) < 0]
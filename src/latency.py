@@ -0,0 +1,197 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Metrics of how long wajig runs take, kept over time.
+
+Each run appends one line to the Metrics file in init_dir: when it ran,
+the command, how long it took, how many packages dpkg changed, how many
+bytes APT downloaded, and the exit status: wajig's own, or when that is
+0, that of the last command it ran to change packages (a listing piped
+through grep that matches nothing is no failure of wajig's). 'wajig
+metrics' summarizes them per command, and can write them out for the
+node_exporter textfile collector, so that e.g. a slower mirror shows up
+in Prometheus."""
+
+import collections
+import math
+import os
+import socket
+import time
+
+# util.init_dir, without importing util, so that its import gets counted
+store = os.path.join(os.path.expanduser("~/.wajig/") + socket.gethostname(),
+                     "Metrics")
+STORE_HEADER = "# wajig metrics 1\n"
+
+# where APT puts what it downloads, and where dpkg notes what it changes
+DOWNLOADS = ["/var/cache/apt/archives", "/var/lib/apt/lists"]
+dpkg_log = "/var/log/dpkg.log"
+DPKG_ACTIONS = {"install", "upgrade", "remove", "purge"}
+
+Record = collections.namedtuple("Record", "time command seconds changed "
+                                          "downloaded status")
+
+
+def stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def restart():
+    """Note the state of things at the start of a run; done at import,
+    and by 'wajig daemon' children for each request."""
+    global started, started_at, before
+    started = time.monotonic()
+    started_at = time.time()
+    before = {path: stat(path) for path in DOWNLOADS + [dpkg_log]}
+
+restart()
+
+
+def packages_changed():
+    """Count the packages dpkg installed, upgraded, or removed so far."""
+    now, then = stat(dpkg_log), before[dpkg_log]
+    if now is None or then is not None and now.st_size == then.st_size:
+        return 0
+    offset = then.st_size if then and then.st_size < now.st_size else 0
+    count = 0
+    with open(dpkg_log, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            fields = line.split(None, 3)
+            if len(fields) > 2 and fields[2].decode() in DPKG_ACTIONS:
+                count += 1
+    return count
+
+
+def bytes_downloaded():
+    """Sum up the size of the files APT has put in place so far.
+
+    APT gives downloaded files the modification time of the server's copy,
+    so new files are told apart by their inode change time instead; and
+    directories whose modification time has not changed are skipped."""
+    total = 0
+    for directory in DOWNLOADS:
+        now, then = stat(directory), before[directory]
+        if now is None or then and now.st_mtime_ns == then.st_mtime_ns:
+            continue
+        for entry in os.scandir(directory):
+            if entry.is_file(follow_symlinks=False):
+                info = entry.stat(follow_symlinks=False)
+                if info.st_ctime >= started_at:
+                    total += info.st_size
+    return total
+
+
+def record(command, status):
+    """Append the metrics of this run of COMMAND to the store."""
+    seconds = time.monotonic() - started
+    try:
+        line = "{:.0f}\t{}\t{:.3f}\t{}\t{}\t{}\n".format(
+            started_at, command, seconds, packages_changed(),
+            bytes_downloaded(), status)
+        new = not os.path.exists(store)
+        with open(store, "a") as f:
+            if new:
+                f.write(STORE_HEADER)
+            f.write(line)
+    except (OSError, ValueError):
+        pass  # never fail a command over its metrics
+
+
+def read(path=None):
+    """Yield the Records in the store."""
+    try:
+        f = open(path or store)
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != len(Record._fields):
+                continue  # cut short, e.g. by a full disk
+            when, command, seconds, changed, downloaded, status = fields
+            yield Record(int(when), command, float(seconds), int(changed),
+                         int(downloaded), int(status))
+
+
+def percentile(values, fraction):
+    """The nearest-rank percentile of sorted VALUES."""
+    return values[max(1, math.ceil(fraction * len(values))) - 1]
+
+
+Summary = collections.namedtuple("Summary", "runs p50 p95 max total "
+                                            "failures changed downloaded "
+                                            "last status")
+
+
+def summarize(records):
+    """Return {command: Summary} of RECORDS."""
+    runs = collections.defaultdict(list)
+    for run in records:
+        runs[run.command].append(run)
+    summaries = dict()
+    for command, records in runs.items():
+        seconds = sorted(run.seconds for run in records)
+        summaries[command] = Summary(
+            len(records), percentile(seconds, 0.5), percentile(seconds, 0.95),
+            seconds[-1], sum(seconds),
+            sum(1 for run in records if run.status),
+            sum(run.changed for run in records),
+            sum(run.downloaded for run in records),
+            records[-1].time, records[-1].status)
+    return summaries
+
+
+# (name, type, help, value of a Summary) of what goes into the textfile
+EXPORTED = [
+    ("wajig_command_packages_changed_total", "counter",
+     "Packages installed, upgraded, or removed by wajig commands.",
+     lambda summary: summary.changed),
+    ("wajig_command_downloaded_bytes_total", "counter",
+     "Bytes downloaded by APT during wajig commands.",
+     lambda summary: summary.downloaded),
+    ("wajig_command_failures_total", "counter",
+     "Runs of wajig commands that exited with a non-zero status.",
+     lambda summary: summary.failures),
+    ("wajig_command_last_run_timestamp_seconds", "gauge",
+     "When a wajig command was last run.",
+     lambda summary: summary.last),
+    ("wajig_command_last_exit_status", "gauge",
+     "Exit status of the last run of a wajig command.",
+     lambda summary: summary.status),
+]
+
+
+def write_textfile(summaries, path):
+    """Write SUMMARIES to PATH in the Prometheus text format.
+
+    The file is written next to PATH first and then renamed over it, so
+    that node_exporter never reads half of it."""
+    lines = ["# HELP wajig_command_duration_seconds How long wajig commands "
+             "took.",
+             "# TYPE wajig_command_duration_seconds summary"]
+    for command in sorted(summaries):
+        summary = summaries[command]
+        label = 'command="{}"'.format(command)
+        lines += ['wajig_command_duration_seconds{{{},quantile="0.5"}} {}'
+                  .format(label, summary.p50),
+                  'wajig_command_duration_seconds{{{},quantile="0.95"}} {}'
+                  .format(label, summary.p95),
+                  "wajig_command_duration_seconds_sum{{{}}} {:.3f}"
+                  .format(label, summary.total),
+                  "wajig_command_duration_seconds_count{{{}}} {}"
+                  .format(label, summary.runs)]
+    for name, kind, description, value in EXPORTED:
+        lines += ["# HELP {} {}".format(name, description),
+                  "# TYPE {} {}".format(name, kind)]
+        lines += ['{}{{command="{}"}} {}'.format(name, command,
+                                                 value(summaries[command]))
+                  for command in sorted(summaries)]
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temporary, path)
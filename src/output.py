@@ -0,0 +1,44 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Machine-readable output of the list commands.
+
+With the global --format option, list commands write their records one
+per line as they are produced, rather than as text laid out for people:
+as JSON objects (json-lines), or as tab-separated values after a line of
+field names (tsv). Records come from generators, so output starts at
+once and memory stays bounded however long the list."""
+
+import json
+import os
+import sys
+
+FORMATS = ["json-lines", "tsv"]
+
+# the --format asked for; None for text
+format = None
+
+
+def tsv_field(value):
+    if value is None:
+        return ""
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t") \
+                     .replace("\n", "\\n")
+
+
+def emit(fields, records, file=None):
+    """Write RECORDS, tuples of values of FIELDS, in the chosen format."""
+    file = file or sys.stdout
+    try:
+        if format == "tsv":
+            print("\t".join(fields), file=file)
+            for record in records:
+                print("\t".join(tsv_field(value) for value in record),
+                      file=file)
+        else:
+            for record in records:
+                print(json.dumps(dict(zip(fields, record))), file=file)
+        file.flush()
+    except BrokenPipeError:
+        # the reader (head, say) has all it wants: stop quietly, and keep
+        # the flush at exit from complaining too
+        os.dup2(os.open(os.devnull, os.O_WRONLY), file.fileno())
@@ -1,17 +1,190 @@
 # This file is part of wajig.  The copyright file is at debian/copyright.
 
 import os
+import sys
+import time
+import locale
 import subprocess
 
+import tracing
+
 
 SIMULATE = False
 TEACH = False
+PROFILE = False
+
+# when wajig started, roughly; for the --profile report
+started = time.monotonic()
+
+# what execute() last returned for a command it logged, i.e. one changing
+# packages, whose failure is wajig's; for the metrics
+last_status = 0
+
+# prefix of commands run with langC (see execute())
+LANGC = "LC_ALL=C; export LC_ALL; "
+
+# characters that need a shell to be interpreted
+SHELL_CHARACTERS = set("|&;<>()$`\\\"'*?[]#~{}\n")
 
 
 def highlight(text):
     return "\x1b[1m{}\x1b[0m".format(text)
 
-output = subprocess.check_output("dpkg --get-selections".split())
+
+class Run:
+    """Record of one external command: how long it took, its exit status,
+    and how many bytes of output it produced (if known)."""
+
+    def __init__(self, command):
+        self.command = " ".join(command.split())
+        self.start = time.monotonic()
+        self.seconds = self.status = self.output = None
+        runs.append(self)
+
+    def done(self, status, output=None):
+        end = time.monotonic()
+        self.seconds = end - self.start
+        self.status = status
+        tracing.record(self.command, self.start, end, status=status)
+        self.output = output
+        return status
+
+runs = list()
+
+
+class Pipe:
+    """Output of a command, read as it is produced, as from os.popen()."""
+
+    def __init__(self, run, process):
+        self.run = run
+        self.process = process
+        self.output = 0
+        self.encoding = locale.getpreferredencoding(False)
+
+    def readline(self):
+        if self.process.stdout.closed:
+            return ""
+        line = self.process.stdout.readline()
+        self.output += len(line)
+        if not line:
+            self.close()
+        return line.decode(self.encoding, errors="replace")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def readlines(self):
+        return list(self)
+
+    def read(self):
+        return "".join(self)
+
+    def close(self):
+        """Return the exit status, or None for success like os.popen()."""
+        if self.run.seconds is None:
+            self.process.stdout.close()
+            self.run.done(self.process.wait(), self.output)
+        return self.run.status or None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def split(command):
+    """Return COMMAND as a list of arguments if it doesn't need a shell."""
+    if SHELL_CHARACTERS.intersection(command):
+        return None
+    argv = command.split()
+    if not argv or "=" in argv[0]:  # a variable assignment
+        return None
+    return argv
+
+
+def run(command, env=None, pipe=False, getoutput=False):
+    """Run COMMAND, without a shell where possible, keeping a Run of it."""
+    argv = split(command)
+    args = dict(args=argv or command, shell=argv is None, env=env)
+    record = Run(command)
+    if pipe:
+        process = subprocess.Popen(stdout=subprocess.PIPE, **args)
+        return Pipe(record, process)
+    if getoutput:
+        try:
+            output = subprocess.check_output(stderr=subprocess.STDOUT, **args)
+        except subprocess.CalledProcessError as error:
+            record.done(error.returncode, len(error.output))
+            raise
+        except OSError as error:
+            record.done(127, 0)
+            raise subprocess.CalledProcessError(
+                127, command, str(error).encode()) from error
+        record.done(0, len(output))
+        return output
+    try:
+        if not PROFILE or sys.stdout.isatty():
+            # A terminal is left to the command, for apt-get's progress
+            # and debconf's dialogs: only the time is kept.
+            return record.done(subprocess.call(**args))
+        # Pass the output on as it comes, counting it on the way.
+        sys.stdout.flush()
+        process = subprocess.Popen(stdout=subprocess.PIPE, **args)
+    except OSError as error:
+        # as a shell would, for a command it cannot run
+        print("{}: {}".format(argv[0] if argv else command, error.strerror),
+              file=sys.stderr)
+        return record.done(127)
+    output = 0
+    while True:
+        chunk = os.read(process.stdout.fileno(), 65536)
+        if not chunk:
+            break
+        output += len(chunk)
+        os.write(sys.stdout.fileno(), chunk)
+    process.stdout.close()
+    return record.done(process.wait(), output)
+
+
+def report(file=sys.stderr):
+    """Print how long each external command took, and the totals per
+    program, to tell time spent in apt-get or dpkg from wajig's own."""
+    wall = time.monotonic() - started
+    print("\n{:>8} {:>6} {:>10}  {}".format("Seconds", "Status", "Bytes",
+                                           "Command"), file=file)
+    print("{}-{}-{}--{}".format("="*8, "="*6, "="*10, "="*51), file=file)
+    programs = dict()
+    for record in runs:
+        if record.seconds is None:  # output left unread
+            record.done(None)
+        argv = record.command.replace(LANGC, "").split()
+        program = os.path.basename(argv[1] if argv[0] == setroot and
+                                   len(argv) > 1 else argv[0])
+        if split(record.command) is None:
+            program = "sh (" + program + ")"
+        count, seconds = programs.get(program, (0, 0))
+        programs[program] = count + 1, seconds + record.seconds
+        print("{:>8.3f} {:>6} {:>10}  {}".format(record.seconds,
+              "-" if record.status is None else record.status,
+              "-" if record.output is None else record.output,
+              record.command[:51]), file=file)
+    print(file=file)
+    external = 0
+    for program, (count, seconds) in sorted(programs.items(),
+                                            key=lambda item: -item[1][1]):
+        external += seconds
+        print("{:>8.3f} {:>6}x  {}".format(seconds, count, program), file=file)
+    print("{:>8.3f}          wajig itself".format(wall - external), file=file)
+
+
+output = run("dpkg --get-selections", getoutput=True)
 output = output.decode().split()
 if "sudo" in output and os.getuid():
     setroot = "/usr/bin/sudo"
@@ -36,6 +209,9 @@ def execute(command, root=False, pipe=False, langC=False, test=False,
     PIPE        If True then return a file-like object.
     LANGC       If LC_TYPE=C is needed (as in join in status command)
 
+    Commands are run without a shell unless they need one, and each is
+    recorded in RUNS (see report()).
+
     Returns either the status of the command or a file-like object
     if PIPE is True."""
 
@@ -50,7 +226,7 @@ def execute(command, root=False, pipe=False, langC=False, test=False,
             # like listnames (in user has no access to sources.list),
             # hold, unhold. So should be sufferable.
             #
-            if '|' in command and subprocess.call(setroot + " -v", shell=True):
+            if '|' in command and run(setroot + " -v"):
                 raise SystemExit("sudo authentication failed.")
             #
             # Bug #320126 noted the following is not good as is since
@@ -75,8 +251,10 @@ def execute(command, root=False, pipe=False, langC=False, test=False,
     # the status command. So the fix now is to not touch the locale
     # except if the cammand asks for it through the langC flag.
     #
+    env = None
+    plain = command
     if langC:
-        command = "LC_ALL=C; export LC_ALL; " + command
+        command = LANGC + command
     if test:
         return command
     elif SIMULATE:
@@ -84,18 +262,21 @@ def execute(command, root=False, pipe=False, langC=False, test=False,
         return
     if TEACH:
         print(highlight(" ".join(command.split())))
+    if langC and split(plain):
+        command, env = plain, dict(os.environ, LC_ALL="C")
     if pipe:
-        return os.popen(command)
+        return run(command, env, pipe=True)
     elif getoutput:
-        return subprocess.check_output(command, shell=True,
-                                       stderr=subprocess.STDOUT)
+        return run(command, env, getoutput=True)
     else:
         if log:
             import tempfile
             import util
             temp = tempfile.mkstemp(dir='/tmp', prefix='wajig_')[1]
             util.start_log(temp)
-        result = subprocess.call(command, shell=True)
+        result = run(command, env)
         if log:
             util.finish_log(temp)
+            global last_status
+            last_status = result
         return result
@@ -0,0 +1,211 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Background service behind 'wajig daemon'.
+
+The service loads the APT cache, the dpkg status, and the indexes derived
+from them once, then forks a child for each request, so that every command
+starts with all of that already in memory. Clients hand over their stdin,
+stdout, and stderr along with the request, so the output goes straight to
+the caller's terminal."""
+
+import array
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+import client
+import latency
+import perform
+import tracing
+import util
+
+socket_path = client.socket_path()
+pid_file = os.path.join(util.init_dir, "Daemon.pid")
+
+# what is kept in memory is reloaded as soon as one of these changes
+WATCHED = [
+    util.dpkg_status,
+    "/var/lib/apt/extended_states",
+    "/var/lib/apt/lists",
+    "/var/cache/apt/pkgcache.bin",
+    "/etc/apt",
+]
+
+
+def signature():
+    stamps = list()
+    for path in WATCHED:
+        try:
+            stamps.append(os.stat(path).st_mtime_ns)
+        except OSError:
+            stamps.append(None)
+    return stamps
+
+
+def load():
+    """(Re)load everything the commands served will need."""
+    util.forget()
+    util.status_table()
+    util.file_index()
+    util.diversions()
+    util.session.changes()
+    util.package_index()
+    for dependency_type in util.dependency_types:
+        util.reverse_dependencies(dependency_type)
+
+
+def receive(connection):
+    """Return the request sent over CONNECTION, and the descriptors with it."""
+    fds = array.array("i")
+    data, ancdata, flags, address = connection.recvmsg(
+        65536, socket.CMSG_LEN(3 * fds.itemsize))
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+    while not data.endswith(b"\n"):
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode()), list(fds)
+
+
+def run(request, connection):
+    """Run a request in a forked child, and report its exit status."""
+    status = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        tracing.restart(os.environ.get("WAJIG_TRACE"), request["argv"])
+        latency.restart()
+        perform.last_status = 0
+        sys.stdout.reconfigure(line_buffering=os.isatty(1))
+        import wajig
+        wajig.main(request["argv"])
+        status = 0
+    except SystemExit as error:
+        if isinstance(error.code, str):
+            print(error.code, file=sys.stderr)
+        status = error.code if isinstance(error.code, int) else \
+                 int(error.code is not None)
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            tracing.write()  # atexit handlers do not run in the child
+            sys.stdout.flush()
+            sys.stderr.flush()
+            connection.sendall("{}\n".format(status).encode())
+        finally:
+            os._exit(status)
+
+
+def handle(listener, connection):
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                        struct.calcsize("3i"))
+    if struct.unpack("3i", credentials)[1] != os.getuid():
+        return
+    request, fds = receive(connection)
+    if len(fds) != 3 or not request["argv"] or \
+       request["argv"][0] not in client.SERVED:
+        for fd in fds:
+            os.close(fd)
+        connection.sendall(b"2\n")
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if os.fork() == 0:
+        try:
+            listener.close()
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+        except BaseException:
+            os._exit(1)
+        run(request, connection)
+    for fd in fds:
+        os.close(fd)
+
+
+def serve():
+    stamp = signature()
+    load()
+    import wajig  # for the children to find it imported already
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o077)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(umask)
+    listener.listen(16)
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # children reap themselves
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            connection, address = listener.accept()
+            with connection:
+                if signature() != stamp:
+                    stamp = signature()
+                    load()
+                try:
+                    handle(listener, connection)
+                except (OSError, ValueError, KeyError):
+                    pass  # a broken request must not take the service down
+    finally:
+        listener.close()
+        os.remove(socket_path)
+
+
+def running():
+    """Return the process id of the running daemon, if there is one."""
+    try:
+        with open(pid_file) as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid
+
+
+def start():
+    if running():
+        print("wajig daemon is already running")
+        return
+    if os.fork():
+        print("Started wajig daemon")
+        return
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(null, fd)
+    os.close(null)
+    with open(pid_file, "w") as f:
+        f.write("{}\n".format(os.getpid()))
+    try:
+        serve()
+    finally:
+        if os.path.exists(pid_file):
+            os.remove(pid_file)
+        os._exit(0)
+
+
+def stop():
+    pid = running()
+    if not pid:
+        print("wajig daemon is not running")
+        return
+    os.kill(pid, signal.SIGTERM)
+    print("Stopped wajig daemon")
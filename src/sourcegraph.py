@@ -0,0 +1,110 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""The build-dependency graph of the source packages in APT's lists.
+
+The Sources lists (there when deb-src lines are in the sources) are read
+once, after they change: for each source package, the binary packages
+it builds and the names it build-depends on, through Build-Depends,
+Build-Depends-Arch, and Build-Depends-Indep, whatever the architecture
+restrictions and build profiles. That is kept in a single file, along
+with a digest of the lists it was read from, and turned around in
+memory into who build-depends on each name."""
+
+import collections
+import os
+import re
+
+import apt_pkg
+
+import tracing
+import util
+
+FIELDS = ["Build-Depends", "Build-Depends-Arch", "Build-Depends-Indep"]
+
+# the package name at the start of an alternative, e.g. "foo:any (>= 1)"
+NAME = re.compile(r"\s*([a-z0-9][a-z0-9+.-]*)")
+
+
+def names(field):
+    """The package names in a build-dependency FIELD, alternatives
+    included, without versions, architectures, or profiles."""
+    found = list()
+    for alternative in re.split(r"[,|]", field):
+        match = NAME.match(alternative)
+        if match:
+            found.append(match.group(1))
+    return found
+
+
+def read_sources(paths):
+    """Return {source: (binaries, build-dependencies)}, sets of names, from
+    the Sources lists at PATHS; the versions of a source are merged."""
+    table = collections.defaultdict(lambda: (set(), set()))
+    for path in paths:
+        with tracing.span("parse " + os.path.basename(path)):
+            for section in apt_pkg.TagFile(path):
+                binaries, depends = table[section["Package"]]
+                binaries.update(names(section.get("Binary", "")))
+                for field in FIELDS:
+                    depends.update(names(section.get(field, "")))
+    return table
+
+
+def write_sources(f, sources):
+    """Write the table read_sources() returns to F, a line per source."""
+    for source in sorted(sources):
+        binaries, depends = sources[source]
+        f.write("{}\t{}\t{}\n".format(source, ",".join(sorted(binaries)),
+                                      ",".join(sorted(depends))))
+
+
+def read_cached(f):
+    """Read back from F what write_sources() wrote."""
+    return {source: (set(binaries.split(",")) - {""},
+                     set(depends.split(",")) - {""})
+            for source, binaries, depends in
+            (line.rstrip("\n").split("\t") for line in f)}
+
+
+class Graph:
+    """Source packages, what they build, and who build-depends on what."""
+
+    def __init__(self, cache, lists=None):
+        """Read the Sources lists in directory LISTS (by default APT's),
+        or, while they are unchanged, the file CACHE made from them."""
+        if lists is None:
+            lists = apt_pkg.config.find_dir("Dir::State::lists")
+        self.lists = [os.path.join(lists, name)
+                      for name in util.apt_lists("Sources", lists)]
+        self.sources = util.cached_lists(
+            self.lists, cache, lambda: read_sources(self.lists),
+            write_sources, read_cached)
+        # {name: sources build-depending on it}
+        self.wanted = collections.defaultdict(set)
+        for source, (binaries, depends) in self.sources.items():
+            for name in depends:
+                self.wanted[name].add(source)
+
+    def rdepends(self, name):
+        """Return the sorted source packages build-depending on NAME."""
+        return sorted(self.wanted.get(name, ()))
+
+    def rebuilds(self, name):
+        """Return (source, round) for each source package to rebuild when
+        package NAME changes: those build-depending on it in round 1, then
+        those build-depending on what those build in round 2, and so on.
+        They are sorted by round, then by name."""
+        rounds = dict()
+        changed = {name}
+        depth = 0
+        while changed:
+            depth += 1
+            sources = set()
+            for package in changed:
+                sources.update(self.wanted.get(package, ()))
+            sources.difference_update(rounds)
+            for source in sources:
+                rounds[source] = depth
+            changed = set().union(*(self.sources[source][0]
+                                    for source in sources))
+        return sorted(rounds.items(), key=lambda item: (item[1], item[0]))
@@ -0,0 +1,87 @@
+# This file is part of wajig.  The copyright file is at debian/copyright.
+
+"""Tracing of the phases of a wajig run.
+
+Spans are always recorded, as that is cheap, but only written out when
+asked for: by setting WAJIG_TRACE to a file name, or with --trace FILE.
+The file is in the Chrome trace event format, so it can be looked at with
+chrome://tracing or https://ui.perfetto.dev. Each span also notes the
+peak resident memory (RSS) so far."""
+
+import atexit
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# where to write the trace; None means nowhere
+path = os.environ.get("WAJIG_TRACE") or None
+
+started = time.monotonic()
+events = list()
+argv = sys.argv[1:]
+
+
+def microseconds(seconds):
+    return int((seconds - started) * 1000000)
+
+
+def peak_rss():
+    """Peak resident memory so far, in kB, of wajig and of its children."""
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def record(name, begin, end, **args):
+    """Add a span NAME from BEGIN to END, as given by time.monotonic()."""
+    args["peak_rss_kb"] = peak_rss()[0]
+    events.append({"name": name, "ph": "X", "pid": os.getpid(),
+                   "tid": threading.get_ident(),
+                   "ts": microseconds(begin),
+                   "dur": microseconds(end) - microseconds(begin),
+                   "args": args})
+
+
+@contextlib.contextmanager
+def span(name, **args):
+    """Record the time spent in the body of the with statement as NAME."""
+    begin = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, begin, time.monotonic(), **args)
+
+
+def enable(filename):
+    global path
+    path = filename
+
+
+def restart(filename, arguments=()):
+    """Start a fresh trace, as a 'wajig daemon' child does for each request."""
+    global started, argv
+    started = time.monotonic()
+    argv = list(arguments)
+    events.clear()
+    enable(filename)
+
+
+def write():
+    if not path:
+        return
+    own, children = peak_rss()
+    run = {"name": "wajig " + " ".join(argv), "ph": "X",
+           "pid": os.getpid(), "tid": threading.get_ident(), "ts": 0,
+           "dur": microseconds(time.monotonic()),
+           "args": {"peak_rss_kb": own, "children_peak_rss_kb": children}}
+    with open(path, "w") as f:
+        json.dump({"traceEvents": [run] + events,
+                   "displayTimeUnit": "ms",
+                   "otherData": {"argv": argv,
+                                 "peak_rss_kb": own,
+                                 "children_peak_rss_kb": children}}, f)
+
+atexit.register(write)
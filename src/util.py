@@ -3,17 +3,29 @@
 "Contains miscellaneous utilities."
 
 import os
+import io
 import sys
+import gzip
 import tempfile
 import re
 import socket
+import tarfile
+import subprocess
+import concurrent.futures
+import collections
+import fnmatch
+import functools
+import itertools
 from datetime import datetime
 import time
 
 import apt
 import apt_pkg
 
+import history
+import output
 import perform
+import tracing
 
 
 #------------------------------------------------------------------------
@@ -70,66 +82,320 @@ if not os.path.exists(new_file):
 
 available_file = init_dir + "/Available"
 previous_file  = init_dir + "/Available.prv"
+# how Available.prv became Available; see update_available()
+delta_file = init_dir + "/Delta"
+# how the available packages changed at every update; see history.py
+history_file = init_dir + "/History"
+# sorted names for bash completion to look up; see refresh_completion()
+completion_dir = init_dir + "/Completion"
+# the build dependencies read from APT's Sources lists; see sourcegraph.py
+sources_cache = init_dir + "/Sources"
+# what each APT package list held when last read; see available_versions()
+lists_cache = init_dir + "/Lists"
 
 # Set the temporary directory to the init_dir.
 # Large files are not generally written there so should be okay.
 tempfile.tempdir = init_dir
 
 
-def newly_available(verbose=False):
-    """display brand-new packages.. technically new package names"""
-    with open(new_file) as f:
-        packages = f.readlines()
-        if verbose:
-            for package in packages:
-                perform.execute('aptitude show ' + package)
+# fields of package records not worth showing to people
+RECORD_NOISE = {"Description", "Description-md5", "Filename", "Size",
+                "MD5sum", "SHA1", "SHA256", "SHA512", "Conffiles", "Status"}
+
+
+def show_version(version):
+    """Print the record of VERSION, as 'apt-cache show' does, but leaving
+    out the checksums and with the (translated) long description."""
+    record = version.record
+    for field in record.keys():
+        if field not in RECORD_NOISE:
+            print("{}: {}".format(field, record[field]))
+    print("State: {}".format("installed" if version.package.installed
+                             else "not installed"))
+    print("Description: " + version.summary)
+    for line in version.raw_description.splitlines()[1:]:
+        print(line)
+    print()
+
+
+def newly_available(verbose=False, limit=None, page=1, since=None):
+    """display brand-new packages.. technically new package names
+
+    With LIMIT, only that many are shown: those on the PAGEth page. With
+    SINCE, those new since then rather than at the last update."""
+    if since is None:
+        with open(new_file) as f:
+            packages = [package.strip() for package in f if package.strip()]
+    else:
+        packages = [package for kind, package, before, after
+                    in delta_since(since, ["new"])]
+    total = len(packages)
+    if limit:
+        packages = packages[(page - 1) * limit:page * limit]
+    if verbose:
+        cache = session.cache
+        for package in packages:
+            if package in cache and cache[package].candidate:
+                show_version(cache[package].candidate)
+            else:
+                print("{}: no longer available\n".format(package))
+    elif packages:
+        do_describe(packages, die=False)
+    if limit and packages:
+        first = (page - 1) * limit
+        print("Showing {}-{} of {} new packages".format(
+              first + 1, first + len(packages), total))
+    elif limit:
+        print("No packages on page {}, of {} new packages".format(page,
+                                                                  total))
+
+
+# lists of a kind in Dir::State::lists, maybe compressed (Acquire::GzipIndexes)
+APT_LIST = r"_{}(\.(gz|xz|bz2|lzma|lz4|zst))?$"
+
+
+def apt_lists(kind, lists):
+    """The sorted names of the APT lists of KIND (Packages or Sources) in
+    directory LISTS."""
+    search = re.compile(APT_LIST.format(kind)).search
+    return sorted(name for name in os.listdir(lists) if search(name))
+
+
+def cached_lists(paths, cached, parse, write, read):
+    """Return what PARSE() makes of the APT lists at PATHS. While they are
+    unchanged it is read back, by READ(f), from the file CACHED; otherwise
+    WRITE(f, parsed) writes it there.
+
+    APT replaces a list by renaming a new one over it, and gives it the
+    modification time of the server's copy, so the inodes, sizes, and
+    modification times together tell whether the lists changed, without
+    reading them."""
+    stats = [os.stat(path) for path in paths]
+    digest = "# {}\n".format(" ".join(
+        "{} {} {}".format(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        for stat in stats))
+    try:
+        with open(cached) as f:
+            if f.readline() == digest:
+                return read(f)
+    except FileNotFoundError:
+        pass
+    parsed = parse()
+    with open(cached + ".new", "w") as f:
+        f.write(digest)
+        write(f, parsed)
+    os.replace(cached + ".new", cached)
+    return parsed
+
+
+def newer(versions, package, version):
+    """Note VERSION of PACKAGE in VERSIONS, unless it has a newer one."""
+    known = versions.get(package)
+    if known is None or known != version and \
+       apt_pkg.version_compare(version, known) > 0:
+        versions[package] = version
+
+
+def read_package_list(path):
+    """Return {package: newest version} in the APT package list at PATH."""
+    versions = dict()
+    for section in apt_pkg.TagFile(path):
+        newer(versions, section["Package"], section["Version"])
+    return versions
+
+
+def cached_package_list(path, cached):
+    """What read_package_list(PATH) returns, kept in the file CACHED; see
+    cached_lists()."""
+    def parse():
+        with tracing.span("parse " + os.path.basename(path)):
+            return read_package_list(path)
+
+    def write(f, versions):
+        for package, version in versions.items():
+            f.write("{} {}\n".format(package, version))
+
+    return cached_lists([path], cached, parse, write,
+                        lambda f: dict(line.split() for line in f))
+
+
+def available_versions(lists=None, cache=None):
+    """Return {package: available version} over the APT package lists in
+    directory LISTS (by default APT's), only parsing those that changed
+    since last time; what each held is kept in directory CACHE.
+
+    For APT's own lists the version is the candidate chosen by the pin
+    policy, the one upgrade would install; otherwise it is the newest."""
+    if cache is None:
+        cache = lists_cache
+    index = None
+    if lists is None:
+        lists = apt_pkg.config.find_dir("Dir::State::lists")
+        index = package_index()
+    os.makedirs(cache, exist_ok=True)
+    names = apt_lists("Packages", lists)
+    versions = dict()
+    for name in names:
+        listed = cached_package_list(os.path.join(lists, name),
+                                     os.path.join(cache, name))
+        if not versions:
+            versions = listed
+            continue
+        for package, version in listed.items():
+            newer(versions, package, version)
+    # forget the lists APT has dropped
+    for name in set(os.listdir(cache)).difference(names):
+        os.remove(os.path.join(cache, name))
+    if index is not None:
+        with tracing.span("candidate versions"):
+            apply_policy(versions, *index[:2])
+    return versions
+
+
+def apply_policy(versions, cache, policy):
+    """Replace each version in {package: version} VERSIONS by the candidate
+    POLICY picks for the package in CACHE, dropping those it would not
+    install; packages CACHE does not know are left as they are."""
+    for package in list(versions):
+        try:
+            candidate = policy.get_candidate_ver(cache[package])
+        except KeyError:
+            continue
+        if candidate is None:
+            del versions[package]
         else:
-            do_describe([package.strip() for package in packages], die=False)
+            versions[package] = candidate.ver_str
+
+
+def version_changes(old, new):
+    """Yield (package, old version, new version, change) for each package
+    that differs between two {package: version}, in package order.
+
+    CHANGE is one of install, remove, upgrade, or downgrade; it is what
+    it takes to turn OLD into NEW. The two are walked side by side, so
+    this is linear in the number of packages."""
+    old_packages, new_packages = sorted(old), sorted(new)
+    i = j = 0
+    while i < len(old_packages) or j < len(new_packages):
+        package = min(old_packages[i:i + 1] + new_packages[j:j + 1])
+        before = old.get(package) if i < len(old_packages) and \
+                 old_packages[i] == package else None
+        after = new.get(package) if j < len(new_packages) and \
+                new_packages[j] == package else None
+        i += before is not None
+        j += after is not None
+        if before is None:
+            yield package, None, after, "install"
+        elif after is None:
+            yield package, before, None, "remove"
+        elif before != after:
+            if apt_pkg.version_compare(before, after) < 0:
+                yield package, before, after, "upgrade"
+            else:
+                yield package, before, after, "downgrade"
+
+
+# what each change of version_changes() means for the available packages
+DELTA_KINDS = {"install": "new", "remove": "removed", "upgrade": "upgraded",
+               "downgrade": "downgraded"}
+
+
+def write_delta(changes, path=None):
+    """Write CHANGES, as from version_changes(), to PATH (the Delta file):
+    one line of kind, package, previous and available version each."""
+    with open(path or delta_file, "w") as f:
+        for package, before, after, change in changes:
+            f.write("{} {} {} {}\n".format(DELTA_KINDS[change], package,
+                                            before or "-", after or "-"))
+
+
+def read_delta(path=None, kinds=None):
+    """Yield (kind, package, previous, available) from the Delta file at
+    PATH, of KINDS (by default, all kinds); missing versions are None."""
+    try:
+        f = open(path or delta_file)
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            kind, package, before, after = line.split()
+            if not kinds or kind in kinds:
+                yield (kind, package, None if before == "-" else before,
+                       None if after == "-" else after)
+
+
+def delta_since(when, kinds=None):
+    """Return (kind, package, previous, available) for each package whose
+    availability changed since time WHEN, of KINDS (by default, all), or
+    None if the history of available packages starts later."""
+    then = history.table_at(when, history_file)
+    if then is None:
+        return None
+    return ((DELTA_KINDS[change], package, before, after)
+            for package, before, after, change
+            in version_changes(then, read_available(available_file))
+            if not kinds or DELTA_KINDS[change] in kinds)
+
+
+def show_delta(kinds=None, since=None):
+    """Show how the available packages changed at the last update (or
+    since time SINCE): those that are new, removed, upgraded, or
+    downgraded (or only KINDS)."""
+    if since is None:
+        changes = read_delta(kinds=kinds)
+    else:
+        changes = delta_since(since, kinds)
+    if output.format:
+        return output.emit(["change", "package", "previous", "available"],
+                           changes)
+    for kind, package, before, after in changes:
+        print("{:<10} {:<32} {:<20} {}".format(kind, package, before or "-",
+                                               after or "-"))
+
+
+def show_history(package):
+    """Show when each version of PACKAGE became available, and when it
+    stopped being available."""
+    records = ((history.show_time(seconds), version) for seconds, version
+               in history.versions(package, history_file))
+    if output.format:
+        return output.emit(["time", "version"], records)
+    for shown, version in records:
+        print("{}  {}".format(shown, version or "(no longer available)"))
 
 
 def update_available(noreport=False):
     """Generate current list of available packages, backing up the old list
     """
-
-    if not os.path.exists(available_file):
-        f = open(available_file, "w")
-        f.close()
-
-    temporary_file = tempfile.mkstemp()[1]
-
-    os.rename(available_file, temporary_file)
-    # sort --unique so packages with more that one architecture are included
-    # only once. This makes the count shown by "update" consistent with the
-    # output of "toupgrade", though not necessarily with the list shown
-    # by "upgrade" (really "apt-get --show-upgraded upgrade"), which might
-    # show amd64 and i386 versions.
-    command = ("apt-cache dumpavail "
-               "| egrep '^(Package|Version):' "
-               "| tr '\n' ' '"
-               "| perl -p -e 's|Package: |\n|g; s|Version: ||g'"
-               "| sort -u -k 1b,1 | tail -n +2 | sed 's| $||' > ") \
-                + available_file
-    # Use langC in the following since it uses a grep.
-    perform.execute(command, langC=True)  # root is not required.
-    os.rename(temporary_file, previous_file)
-
-    available_packages = open(available_file).readlines()
-    previous_packages = open(previous_file).readlines()
-    diff = len(available_packages) - len(previous_packages)
-
-    temporary_file = tempfile.mkstemp()[1]
-    # 090425 Use langC=True to work with change from coreutils 6.10 to 7.2
-    command = "join -v 1 -t' '  {0} {1} | cut -d' ' -f 1 | tee {2} | wc -l"
-    command = command.format(available_file, previous_file, temporary_file)
-    newest = perform.execute(command, pipe=True, langC=True)
-    newest = newest.readlines()[0].strip()
-
-    if newest != "0":
-      os.rename(temporary_file, new_file)
+    previous = read_available(available_file)
+    with tracing.span("available versions"):
+        available = available_versions()
+    if os.path.exists(available_file):
+        os.replace(available_file, previous_file)
     else:
-      os.remove(temporary_file)
+        open(previous_file, "w").close()
+    # one version per package name, however many architectures have it:
+    # this makes the count shown by "update" consistent with the output of
+    # "toupgrade", though not necessarily with the list shown by "upgrade"
+    # (really "apt-get --show-upgraded upgrade"), which might show amd64
+    # and i386 versions.
+    with open(available_file, "w") as f:
+        for package in sorted(available):
+            f.write("{} {}\n".format(package, available[package]))
+
+    changes = list(version_changes(previous, available))
+    write_delta(changes)
+    history.record(previous, available, history_file)
+    counts = collections.Counter(change for package, before, after, change
+                                 in changes)
+    newest = [package for package, before, after, change in changes
+              if change == "install"]
+    if newest:
+        with open(new_file, "w") as f:
+            f.write("".join(package + "\n" for package in newest))
 
     if not noreport:
+        diff = len(available) - len(previous)
         if diff < 0:
             direction = str(0 - diff) + " down on"
         elif diff == 0:
@@ -137,16 +403,23 @@ def update_available(noreport=False):
         else:
             direction = str(diff) + " up on"
         print("This is " + direction + " the previous count", end=' ')
-        print("with " + newest + " new", end=' ')
-        if newest == "1":
-            print("package.")
+        print("with " + str(len(newest)) + " new", end=' ')
+        if len(newest) == 1:
+            print("package", end='')
         else:
-            print("packages.")
+            print("packages", end='')
+        print(", {} removed, {} upgraded, and {} downgraded.".format(
+              counts["remove"], counts["upgrade"], counts["downgrade"]))
+
+dpkg_status = "/var/lib/dpkg/status"
+dpkg_info = "/var/lib/dpkg/info"
+dpkg_diversions = "/var/lib/dpkg/diversions"
+
 
 def gen_installed_command_str():
     """Generate command to list installed packages and their status."""
     # Use sort --unique. See comment in update_available().
-    command = ("cat /var/lib/dpkg/status | "
+    command = ("cat " + dpkg_status + " | "
                "egrep '^(Package|Status|Version):' | "
                "awk '/^Package: / {pkg=$2} "
                "     /^Status: / {s1=$2;s2=$3;s3=$4}"
@@ -155,21 +428,297 @@ def gen_installed_command_str():
     return command
 
 
+def read_status(path):
+    """Return the sections of a dpkg status database, in order. This is
+    the one parse of it that the tables below are all made from."""
+    with tracing.span("parse dpkg status", path=path), open(path) as f:
+        return list(apt_pkg.TagFile(f))
+
+
+@functools.lru_cache(maxsize=None)
+def status_sections():
+    """The dpkg status database of this host; see read_status()."""
+    return read_status(dpkg_status)
+
+
+def status_by_name(sections):
+    """Map package names to their SECTIONS of a dpkg status database.
+
+    When a package is listed for several architectures, one that is
+    installed wins."""
+    table = dict()
+    for section in sections:
+        name = section["Package"]
+        if name not in table or \
+           section.get("Status", "").endswith("ok installed"):
+            table[name] = section
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def status_table():
+    """The dpkg status database of this host; see status_by_name()."""
+    return status_by_name(status_sections())
+
+
+def qualified_name(section, native=None, same=True):
+    """The name of the package in SECTION (of a dpkg status database, or
+    of APT's extended states), with the architecture added when it is not
+    NATIVE (by default APT's) nor all. With SAME, it is also added for
+    Multi-Arch: same packages, as dpkg shows them; without, the name is
+    as APT gives it."""
+    if native is None:
+        native = apt_pkg.config.find("APT::Architecture")
+    name = section["Package"]
+    architecture = section.get("Architecture", "")
+    if same and section.get("Multi-Arch") == "same" or \
+       architecture not in (native, "all", ""):
+        name += ":" + architecture
+    return name
+
+
+def native_architecture(sections):
+    """The architecture of the host a dpkg status database with SECTIONS
+    comes from: that of its dpkg, or else APT's."""
+    for section in sections:
+        if section["Package"] == "dpkg" and "Architecture" in section:
+            return section["Architecture"]
+    return apt_pkg.config.find("APT::Architecture")
+
+
+def installed_versions(table=None):
+    """Return {package: version} of installed packages, like the output of
+    gen_installed_command_str() but without running a pipeline."""
+    if table is None:
+        table = status_table()
+    return {name: section["Version"]
+            for name, section in table.items()
+            if section.get("Status", "").endswith("ok installed")}
+
+
+def installed_instances(sections=None):
+    """Return {package: version} of installed packages, named as APT
+    names them on the host they are installed on (see qualified_name()),
+    so that each instance of a package installed for several
+    architectures is kept apart. SECTIONS are those of a dpkg status
+    database, by default this host's."""
+    if sections is None:
+        sections = status_sections()
+    native = native_architecture(sections)
+    return {qualified_name(section, native, same=False): section["Version"]
+            for section in sections
+            if section.get("Status", "").endswith("ok installed")}
+
+
+Selection = collections.namedtuple("Selection", "name want error status "
+                                                "version architecture "
+                                                "summary")
+
+
+def read_selections(sections):
+    """Return a Selection for each package in the SECTIONS of a dpkg
+    status database, sorted and named as dpkg shows them; see
+    qualified_name()."""
+    native = apt_pkg.config.find("APT::Architecture")
+    table = list()
+    for section in sections:
+        want, error, status = section.get("Status", "unknown ok "
+                                          "not-installed").split()
+        summary = section.get("Description", "").partition("\n")[0]
+        table.append(Selection(qualified_name(section, native), want, error,
+                               status, section.get("Version", ""),
+                               section.get("Architecture", ""), summary))
+    table.sort(key=lambda selection: (selection.name.partition(":")[0],
+                                      selection.architecture))
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def selections():
+    """The Selections of this host; see read_selections()."""
+    return read_selections(status_sections())
+
+
+def select(pattern=None, want=None, status=None, table=None):
+    """Return the Selections whose name matches PATTERN (a Python regular
+    expression, searched for anywhere in the name), whose wanted state is
+    WANT (e.g. "hold"), and whose status is STATUS (e.g. "config-files").
+
+    Packages that dpkg knows of but that are not installed at all are
+    left out, as 'dpkg --get-selections' does, unless STATUS asks for
+    them."""
+    if table is None:
+        table = selections()
+    search = re.compile(pattern).search if pattern else None
+    return [selection for selection in table
+            if (selection.status == status if status else
+                selection.status != "not-installed")
+            and (not want or selection.want == want)
+            and (not search or search(selection.name))]
+
+
+# the letters 'dpkg --list' shows for wanted states and for statuses
+WANT_FLAGS = {"unknown": "u", "install": "i", "hold": "h", "deinstall": "r",
+              "purge": "p"}
+STATUS_FLAGS = {"not-installed": "n", "config-files": "c",
+                "half-installed": "H", "unpacked": "U",
+                "half-configured": "F", "triggers-awaited": "W",
+                "triggers-pending": "t", "installed": "i"}
+
+
+def selection_flags(selection):
+    """Return the three letters of 'dpkg --list' for SELECTION, e.g. "ii "."""
+    return (WANT_FLAGS.get(selection.want, "?") +
+            STATUS_FLAGS.get(selection.status, "?") +
+            (" " if selection.error == "ok" else "R"))
+
+
+def print_selections(table):
+    """Print TABLE of Selections like 'dpkg --list' does."""
+    widths = [max([len(heading)] + [len(getattr(selection, field))
+                                    for selection in table])
+              for heading, field in [("Name", "name"), ("Version", "version"),
+                                     ("Architecture", "architecture")]]
+    line = "{} {:<%d} {:<%d} {:<%d} {}" % tuple(widths)
+    print("Desired=Unknown/Install/Remove/Purge/Hold\n"
+          "| Status=Not/Inst/Conf-files/Unpacked/halF-conf/Half-inst/"
+          "trig-aWait/Trig-pend\n"
+          "|/ Err?=(none)/Reinst-required (Status,Err: uppercase=bad)")
+    print(line.format("||/", "Name", "Version", "Architecture",
+                      "Description"))
+    print(line.format("+++", *["=" * width for width in widths],
+                      "=" * 40).replace(" ", "-"))
+    for selection in table:
+        print(line.format(selection_flags(selection), selection.name,
+                          selection.version, selection.architecture,
+                          selection.summary))
+
+
+def set_selections(packages, selection):
+    """Set the dpkg selection of each of PACKAGES to SELECTION (e.g. "hold"
+    or "install"), all with a single run of dpkg as root."""
+    listing = tempfile.mkstemp()[1]
+    try:
+        with open(listing, "w") as f:
+            f.writelines("{} {}\n".format(package, selection)
+                         for package in packages)
+        status = perform.execute("dpkg --set-selections < " + listing,
+                                 root=True)
+    finally:
+        os.remove(listing)
+    status_sections.cache_clear()
+    status_table.cache_clear()
+    selections.cache_clear()
+    return status
+
+
+@functools.lru_cache(maxsize=None)
+def file_index():
+    """Map each file dpkg knows about to the packages that ship it."""
+    index = collections.defaultdict(list)
+    with tracing.span("read dpkg file lists"):
+        for entry in os.scandir(dpkg_info):
+            if entry.name.endswith(".list"):
+                package = entry.name[:-len(".list")]
+                with open(entry.path, errors="surrogateescape") as f:
+                    for line in f:
+                        index[line.rstrip("\n")].append(package)
+    return index
+
+
+Diversion = collections.namedtuple("Diversion", "source target package")
+
+
+def read_diversions(path):
+    """Map both paths of each diversion in the dpkg diversions database at
+    PATH to its Diversion. It holds three lines per diversion: the path
+    diverted, where it is diverted to, and the package diverting it, or
+    ":" for a local diversion."""
+    table = dict()
+    try:
+        with open(path, errors="surrogateescape") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return table
+    for source, target, package in zip(*[iter(lines)] * 3):
+        diversion = Diversion(source, target,
+                              None if package == ":" else package)
+        table[source] = table[target] = diversion
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def diversions():
+    """The diversions of this host; see read_diversions()."""
+    return read_diversions(dpkg_diversions)
+
+
+def show_diversion(diversion):
+    """The lines dpkg --search prints for DIVERSION."""
+    who = "local diversion" if diversion.package is None else \
+          "diversion by " + diversion.package
+    return ["{} from: {}".format(who, diversion.source),
+            "{} to: {}".format(who, diversion.target)]
+
+
+def search_files(pattern):
+    """Yield (packages, path, diversion) of files matching PATTERN, as dpkg
+    --search does: glob patterns must match the whole path, absolute paths
+    are matched exactly, and anything else matches as a substring. Paths
+    that files are diverted to are no package's, and DIVERSION is None
+    for paths that are not diverted."""
+    index = file_index()
+    diverted = diversions()
+    if not any(c in pattern for c in "*?["):
+        if pattern.startswith("/"):
+            if pattern in index or pattern in diverted:
+                yield index.get(pattern, []), pattern, diverted.get(pattern)
+            return
+        pattern = "*" + pattern + "*"
+    match = re.compile(fnmatch.translate(pattern)).match
+    for path in sorted(index.keys() | diverted.keys()):
+        if match(path):
+            yield index.get(path, []), path, diverted.get(path)
+
+
+dependency_types = ["Depends", "Recommends", "Suggests", "Replaces",
+                    "Enhances"]
+
+
+@functools.lru_cache(maxsize=None)
+def reverse_dependencies(dependency_type):
+    """Map package names to the packages that have a DEPENDENCY_TYPE
+    relationship on them (through their candidate versions)."""
+    index = collections.defaultdict(list)
+    cache = session.cache
+    with tracing.span("index reverse dependencies", type=dependency_type):
+        for package in cache:
+            for name in extract_dependencies(package, dependency_type):
+                dependents = index[name]
+                if not dependents or dependents[-1] != package.shortname:
+                    dependents.append(package.shortname)
+    return index
+
+
+def forget():
+    """Drop the APT cache and every index derived from it or from dpkg,
+    so that they are read afresh when next needed."""
+    session.reset()
+    status_sections.cache_clear()
+    status_table.cache_clear()
+    selections.cache_clear()
+    file_index.cache_clear()
+    diversions.cache_clear()
+    reverse_dependencies.cache_clear()
+
+
 def count_upgrades():
-    """Return as a string the number of new upgrades since last update."""
-    ifile = tempfile.mkstemp()[1]
-    # Use langC in the following since it uses a grep.
-    perform.execute(gen_installed_command_str() + " > " + ifile, langC=True)
-    command = ("join %s %s |"
-               "awk '$2 != $3 {print}' | sort -k 1b,1 | join - %s |"
-               "awk '$4 != $3 {print}' | wc -l | awk '{print $1}' ") % \
-               (previous_file, available_file, ifile)
-    # 090425 Use langC=True to work with change from coreutils 6.10 to 7.2
-    count = perform.execute(command, pipe=True,
-            langC=True).read().split()[0]
-    if os.path.exists(ifile):
-        os.remove(ifile)
-    return count
+    """Return the number of installed packages whose available version
+    changed at the last update, to one they don't have."""
+    installed = installed_versions()
+    return sum(1 for kind, package, before, after in
+               read_delta(kinds=["upgraded", "downgraded"])
+               if package in installed and installed[package] != after)
 
 
 def reset_files():
@@ -226,29 +775,278 @@ def package_exists(cache, package, test=False, ignore_virtual_packages=False):
             sys.exit(1)
 
 
+class Session:
+    """APT state shared by everything done during one wajig invocation.
+
+    Opening the cache and resolving an upgrade each take seconds, so each
+    is done at most once per run, however many helpers ask for them."""
+
+    def __init__(self):
+        self._cache = None
+        self._index = None
+        self._changes = dict()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            with tracing.span("apt.Cache()"):
+                self._cache = apt.Cache()
+        return self._cache
+
+    @property
+    def index(self):
+        """APT's binary package cache, with its pin policy and package
+        records: enough to look up names and descriptions. They are opened
+        with apt_pkg, which is much quicker than opening the cache, as that
+        wraps every package in Python; both map the same pkgcache.bin, so
+        having both open does not build or read it twice."""
+        if self._index is None:
+            with tracing.span("apt_pkg.Cache()"):
+                cache = apt_pkg.Cache(None)
+                policy = apt_pkg.Policy(cache)
+                policy.init_defaults()
+                preferences = apt_pkg.config.find_file(
+                    "Dir::Etc::preferences")
+                if os.path.exists(preferences):
+                    policy.read_pinfile(preferences)
+                parts = apt_pkg.config.find_dir("Dir::Etc::preferencesparts")
+                if os.path.isdir(parts):
+                    policy.read_pindir(parts)
+                self._index = cache, policy, apt_pkg.PackageRecords(cache)
+        return self._index
+
+    def changes(self, distupgrade=False):
+        """Packages an upgrade (or dist-upgrade) would change."""
+        if distupgrade not in self._changes:
+            cache = self.cache
+            if self._changes:
+                # the marks of the other kind of upgrade go, and so must
+                # what was noted of them
+                cache.clear()
+                self._changes.clear()
+            with tracing.span("cache.upgrade()", dist_upgrade=distupgrade):
+                cache.upgrade(distupgrade)
+                self._changes[distupgrade] = cache.get_changes()
+        return self._changes[distupgrade]
+
+    def reset(self):
+        """Forget everything, e.g. because the package lists were updated."""
+        self._cache = None
+        self._index = None
+        self._changes.clear()
+
+session = Session()
+
+
 def upgradable(distupgrade=False, get_names_only=True):
     "Checks if the system is upgradable."
-    cache = apt.Cache()
-    cache.upgrade(distupgrade)
+    packages = session.changes(distupgrade)
     if get_names_only:
-        packages = [package.name for package in cache.get_changes()]
+        packages = [package.name for package in packages]
     else:
-        packages = [package for package in cache.get_changes()]
+        packages = list(packages)
     return packages
 
 
-def local_changelog(package, tmp):
-    """Retrieve Debian changelog from local installation."""
+def local_changelog(package):
+    """Return the path of the Debian changelog from local installation."""
     changelog = "/usr/share/doc/" + package + "/changelog.Debian.gz"
     changelog_native = "/usr/share/doc/" + package + "/changelog.gz"
     if os.path.exists(changelog):
-        return "zcat {0} >> {1}".format(changelog, tmp)
+        return changelog
     elif os.path.exists(changelog_native):
-        return "zcat {0} >> {1}".format(changelog_native, tmp)
+        return changelog_native
     else:
         print("Package", package, "is likely broken (changelog not found)!")
 
 
+archives_dir = "/var/cache/apt/archives"
+
+
+def archive_path(version):
+    """Path a candidate VERSION is (or would be) downloaded to by APT."""
+    # APT escapes the epoch colon when naming downloaded archives
+    filename = "{}_{}_{}.deb".format(version.package.shortname,
+                                     version.version.replace(":", "%3a"),
+                                     version.architecture)
+    return os.path.join(archives_dir, filename)
+
+
+Archive = collections.namedtuple("Archive", "package version architecture "
+                                            "path size")
+
+
+def archive_index(directory=None):
+    """Map package names to the Archives of them in the download cache,
+    oldest version first, as ordered by APT."""
+    index = collections.defaultdict(list)
+    for entry in os.scandir(directory or archives_dir):
+        if not entry.name.endswith(".deb") or entry.name.count("_") != 2 \
+           or not entry.is_file():
+            continue
+        package, version, architecture = entry.name[:-len(".deb")].split("_")
+        index[package].append(Archive(package, version.replace("%3a", ":"),
+                                      architecture, entry.path,
+                                      entry.stat().st_size))
+    newer = functools.cmp_to_key(lambda a, b: apt_pkg.version_compare(
+                                     a.version, b.version))
+    for archives in index.values():
+        archives.sort(key=newer)
+    return index
+
+
+def archives_of(package, index, native=None):
+    """The Archives in INDEX (see archive_index()) of PACKAGE, a name that
+    may be qualified by an architecture, as in "libc6:i386"; unqualified,
+    those of the NATIVE architecture (by default APT's) or of "all"."""
+    name, _, architecture = package.partition(":")
+    if architecture:
+        wanted = [architecture]
+    else:
+        wanted = [native or apt_pkg.config.find("APT::Architecture"), "all"]
+    return [archive for archive in index.get(name, [])
+            if archive.architecture in wanted]
+
+
+# what the archives in the download cache are, in the order reported
+ARCHIVE_CATEGORIES = ["installed", "newer", "superseded", "orphaned"]
+
+
+def archive_categories(index=None, installed=None):
+    """Yield (category, Archive) for each archive in the download cache.
+
+    An archive is "installed" if it is of the installed version, "newer"
+    if it is newer than that, "superseded" if it is older than that or
+    than another archive of a package that is not installed, and
+    "orphaned" if it is the newest archive of such a package."""
+    if index is None:
+        index = archive_index()
+    if installed is None:
+        installed = installed_versions()
+    for package in sorted(index):
+        archives = index[package]
+        current = installed.get(package)
+        for archive in archives:
+            if current is None:
+                category = "orphaned" if archive is archives[-1] else \
+                           "superseded"
+            else:
+                order = apt_pkg.version_compare(archive.version, current)
+                category = "installed" if order == 0 else \
+                           "newer" if order > 0 else "superseded"
+            yield category, archive
+
+
+def prunable_archives(index, keep):
+    """Return the Archives in INDEX beyond the newest KEEP versions of each
+    package and architecture."""
+    prunable = list()
+    for archives in index.values():
+        kept = collections.Counter()
+        for archive in reversed(archives):
+            kept[archive.architecture] += 1
+            if kept[archive.architecture] > keep:
+                prunable.append(archive)
+    return sorted(prunable, key=lambda archive: archive.path)
+
+
+def deb_member(debpath, member):
+    """Return the contents of MEMBER in the data tarball of a .deb, or None.
+
+    The tarball is streamed from dpkg-deb and abandoned as soon as the
+    member is found, so nothing else gets extracted."""
+    member = member.lstrip("./")
+    command = ["dpkg-deb", "--fsys-tarfile", debpath]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+            for info in tar:
+                if info.name.lstrip("./") == member:
+                    if info.isfile():
+                        return tar.extractfile(info).read()
+                    return None
+    except tarfile.TarError:
+        return None
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def candidate_changelog(package):
+    """Return the lines of the changelog of the candidate version of PACKAGE.
+
+    A .deb already sitting in the download cache is preferred; otherwise
+    the changelog is fetched from the network."""
+    path = archive_path(package.candidate)
+    if os.path.exists(path):
+        member = "usr/share/doc/{}/changelog.Debian.gz"
+        data = deb_member(path, member.format(package.shortname))
+        if data is not None:
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)),
+                                    errors="replace")
+    return io.StringIO(package.get_changelog())
+
+
+changelog_header = re.compile(r"^\S+ \(([^)\s]+)\)")
+
+
+def changelog_entries(lines, since=None):
+    """Yield (version, lines) for each entry of a Debian changelog.
+
+    Entries come newest first; reading stops at the first entry that is
+    not newer than SINCE, so a gzip changelog is only decompressed as far
+    as needed. Anything before the first entry (like a download failure
+    message) is yielded with a version of None."""
+    version, entry = None, list()
+    for line in lines:
+        match = changelog_header.match(line)
+        if match:
+            if entry:
+                yield version, entry
+            version, entry = match.group(1), list()
+            if since and apt_pkg.version_compare(version, since) <= 0:
+                return
+        entry.append(line)
+    if entry:
+        yield version, entry
+
+
+def read_news(path, name, since=None):
+    """Return the NEWS.Debian entries of package NAME in the .deb at PATH
+    that are newer than version SINCE."""
+    member = "usr/share/doc/{}/NEWS.Debian.gz".format(name)
+    data = deb_member(path, member)
+    if data is None:
+        return list()
+    lines = io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(data)),
+                             errors="replace")
+    return [entry for version, entry in changelog_entries(lines, since)
+                  if version is not None]
+
+
+def pending_news(packages):
+    """Yield (name, entries) of new NEWS.Debian entries for PACKAGES.
+
+    Only candidates already in the download cache are looked at; the
+    archives are read in parallel, but results keep the order given. The
+    packages are only looked at here: the workers get paths and versions."""
+    wanted = list()
+    for package in packages:
+        path = archive_path(package.candidate)
+        if os.path.exists(path):
+            since = package.installed.version if package.is_installed \
+                    else None
+            wanted.append((path, package.shortname, since))
+    with concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1) as pool:
+        futures = [pool.submit(read_news, *args) for args in wanted]
+        for (path, name, since), future in zip(wanted, futures):
+            entries = future.result()
+            if entries:
+                yield name, entries
+
+
 def extract_dependencies(package, dependency_type="Depends"):
     """Produce all Dependencies of a particular type"""
     if not package.candidate:
@@ -258,6 +1056,95 @@ def extract_dependencies(package, dependency_type="Depends"):
             yield dependency.name
 
 
+@functools.lru_cache(maxsize=None)
+def foreign_architectures():
+    """The architectures dpkg is configured for besides the native one."""
+    native = apt_pkg.config.find("APT::Architecture")
+    return [arch for arch in apt_pkg.get_architectures() if arch != native]
+
+
+def package_index():
+    """Return APT's binary package cache, pin policy, and package records;
+    see Session.index."""
+    return session.index
+
+
+def available_summaries():
+    """Yield (name, summary) of each package that can be downloaded, by
+    name."""
+    cache, policy, records = package_index()
+    names = sorted({package.name for package in cache.packages})
+    for name in names:
+        for qualified in [name] + ["{}:{}".format(name, arch)
+                                   for arch in foreign_architectures()]:
+            try:
+                version = policy.get_candidate_ver(cache[qualified])
+            except KeyError:
+                continue
+            if version and version.downloadable:
+                records.lookup(version.translated_description.file_list[0])
+                yield name, records.short_desc
+                break
+
+
+def describe_packages(names):
+    """Yield (name, summary, description) for each of NAMES, in order.
+
+    A name that is not known natively is looked for in the foreign
+    architectures; for one not found at all, summary and description are
+    None."""
+    cache, policy, records = package_index()
+    for name in names:
+        version = None
+        for qualified in [name] + ["{}:{}".format(name, arch)
+                                   for arch in foreign_architectures()]:
+            try:
+                package = cache[qualified]
+            except KeyError:
+                continue
+            version = package.current_ver or \
+                      policy.get_candidate_ver(package)
+            if version:  # else only a virtual package
+                break
+        if not version:
+            yield name, None, None
+            continue
+        records.lookup(version.translated_description.file_list[0])
+        lines = records.long_desc.splitlines()[1:]
+        description = "\n".join("" if line == " ." else line[1:]
+                                 for line in lines)
+        yield package.name, records.short_desc, description
+
+
+def search_packages(patterns, summaries=False):
+    """Return (name, summary) of each package, by name, whose name or a
+    name it provides (or, with SUMMARIES, its name or summary) matches
+    every one of PATTERNS, Python regular expressions ignoring case, as
+    'apt-cache search' does."""
+    cache, policy, records = package_index()
+    searches = [re.compile(pattern, re.IGNORECASE).search
+                for pattern in patterns]
+    found = dict()
+    for package in cache.packages:
+        if package.name in found:
+            continue
+        version = package.current_ver or policy.get_candidate_ver(package)
+        if not version:  # only a virtual package
+            continue
+        if not summaries:
+            names = [package.name] + [provided for provided, _, _
+                                      in version.provides_list]
+            if not any(all(search(name) for search in searches)
+                       for name in names):
+                continue
+        records.lookup(version.translated_description.file_list[0])
+        line = "{} - {}".format(package.name, records.short_desc)
+        if summaries and not all(search(line) for search in searches):
+            continue
+        found[package.name] = records.short_desc
+    return sorted(found.items())
+
+
 def do_describe(packages, verbose=False, die=True):
     """Display package description(s)"""
 
@@ -271,59 +1158,49 @@ def do_describe(packages, verbose=False, die=True):
             print("="*72)
             sys.stdout.flush()
 
-    if package_names:
-        packages = package_names
-    else:
+    if not package_names:
         return
 
-    if not packages:
-        print("No packages found from those known to be available/installed.")
+    if output.format:
+        fields = ["package", "summary", "description"]
+        if not verbose:
+            fields.pop()
+        return output.emit(fields, (record[:len(fields)] for record in
+                                    describe_packages(
+                                        dict.fromkeys(package_names))))
+
+    # each package once, in the order given
+    descriptions = list()
+    for name, summary, description in \
+            describe_packages(dict.fromkeys(package_names)):
+        if summary is None:
+            if die:
+                print("The cache has no package named '{}'".format(name))
+                return 1
+            continue
+        descriptions.append((name, summary, description))
+    descriptions = list(dict.fromkeys(descriptions))
+    if verbose:
+        for name, summary, description in descriptions:
+            print("{}: {}\n{}\n".format(name, summary, description))
     else:
-        packageversions = list()
-        cache = apt.cache.Cache()
-        for package in packages:
-            try:
-                package = cache[package]
-            except KeyError as e:
-                import subprocess
-                command = 'dpkg --print-foreign-architectures'.split()
-                output = subprocess.check_output(command)
-                for arch in output.decode().split():
-                    try:
-                        package = cache["{}:{}".format(package, arch)]
-                        # to avoid noise, only consider the 1st match
-                        break
-                    except KeyError:
-                        pass
-                if not isinstance(package, apt.package.Package) and die:
-                    print(str(e).strip('"'))
-                    return 1
-            packageversion = package.installed
-            if not packageversion:  # if package is not installed...
-                packageversion = package.candidate
-            packageversions.append((package.shortname, packageversion.summary,
-                                packageversion.description))
-        packageversions = set(packageversions)
-        if verbose:
-            for packageversion in packageversions:
-                print("{}: {}\n{}\n".format(packageversion[0],
-                                            packageversion[1],
-                                            packageversion[2]))
-        else:
-            print("{0:24} {1}".format("Package", "Description"))
-            print("="*24 + "-" + "="*51)
-            for packageversion in packageversions:
-                print("%-24s %s" % (packageversion[0], packageversion[1]))
+        print("{0:24} {1}".format("Package", "Description"))
+        print("="*24 + "-" + "="*51)
+        for name, summary, description in descriptions:
+            print("%-24s %s" % (name, summary))
 
 
 def show_package_versions():
-    packages = upgradable(get_names_only=False)
-    if packages:
+    packages = sorted(upgradable(get_names_only=False))
+    records = ((package.name, package.candidate.version,
+                package.installed.version) for package in packages)
+    if output.format:
+        output.emit(["package", "available", "installed"], records)
+    elif packages:
         print("{:<24} {:<24} {}".format("Package", "Available", "Installed"))
         print("="*24 + "-" + "="*24 + "-" + "="*24)
-        for package in sorted(packages):
-            print("{:<24} {:<24} {}".format(package.name,
-                package.candidate.version, package.installed.version))
+        for record in records:
+            print("{:<24} {:<24} {}".format(*record))
     return packages
 
 
@@ -331,7 +1208,7 @@ def display_sys_docs(package, filenames):
     """This services README and NEWS commands"""
     docpath = os.path.join("/usr/share/doc", package)
     if not os.path.exists(docpath):
-        if package_exists(apt.Cache(), package):
+        if package_exists(session.cache, package):
             print("'{}' is not installed".format(package))
         return
     found = False
@@ -350,60 +1227,58 @@ def display_sys_docs(package, filenames):
         print("File not found")
 
 
-def do_status(packages, snapshot=False):
+def read_available(path):
+    """Map package names to versions, from an Available file."""
+    versions = dict()
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    versions[fields[0]] = fields[1]
+    except FileNotFoundError:
+        pass
+    return versions
+
+
+def status_records(packages=()):
+    """Yield (package, installed, previous, available, state) for the
+    installed PACKAGES (or all of them), then for those of PACKAGES that
+    are only available, with None as the state. Versions that are not
+    known are "N/A"."""
+    installed = installed_versions()
+    table = status_table()
+    previous = read_available(previous_file)
+    available = read_available(available_file)
+    wanted = set(packages)
+    for name in sorted(installed):
+        if not wanted or name in wanted:
+            yield (name, installed[name], previous.get(name, "N/A"),
+                   available.get(name, "N/A"),
+                   table[name]["Status"].split()[0])
+    for name in packages:
+        if name not in installed and name in available:
+            yield (name, "N/A", previous.get(name, "N/A"), available[name],
+                   None)
+
+
+def do_status(packages):
     """List status of the packages identified"""
-
-    if not snapshot:
-        print("%-23s %-15s %-15s %-15s %s" % \
-              ("Package", "Installed", "Previous", "Now", "State"))
-        print("="*23 + "-" + "="*15 + "-" + "="*15 + "-" + "="*15 + "-" + "="*5)
-        sys.stdout.flush()
-
-    # Generate a temporary file of installed packages.
-    ifile = tempfile.mkstemp()[1]
-
-    perform.execute(gen_installed_command_str() + " > " + ifile,
-                    langC=True)
-    # Build the command to list the status of installed packages.
-    command = "dpkg --get-selections | sort | join - " + ifile + " | " +\
-              "join -a 1 - " + previous_file + " | " +\
-              "awk 'NF==3 {print $0, \"N/A\"; next}{print}' | " +\
-              "join -a 1 - " + available_file + " | " +\
-              "awk 'NF==4 {print $0, \"N/A\"; next}{print}' | "
-    if len(packages) > 0:
-        # Use grep, not egrep, otherwise g++ gets lost, for example!
-        command = command + "grep '^\($"
-        for i in packages:
-            command = command + " \|" + i
-        command = command + " \)' |"
-
-    command = command +\
-              "awk '{printf(\"%-20s\\t%-15s\\t%-15s\\t%-15s\\t%-2s\\n\", " +\
-              "$1, $3, $4, $5, $2)}'"
-    if snapshot:
-        fobj = perform.execute(command, pipe=True)
-        for l in fobj:
-            print("=".join(l.split()[0:2]))
-    else:
-        perform.execute(command, langC=True)
-
-    # Check whether the package is not in the installed list, and if not
-    # list its status appropriately.
-    for i in packages:
-        if perform.execute("egrep '^" + i + " ' " + ifile + " >/dev/null"):
-            # Package is not installed.
-            command = \
-              "join -a 2 " + previous_file + " " + available_file + " | " +\
-              "awk 'NF==2 {print $1, \"N/A\", $2; next}{print}' | " +\
-              "egrep '^" + i + " '"
-            command = command +\
-              " | awk '{printf(\"%-20s\\t%-15s\\t%-15s\\t%-15s\\n\", " +\
-              "$1, \"N/A\", $2, $3)}'"
-            perform.execute(command, langC=True)
-
-    # Tidy up - remove the "installed file"
-    if os.path.exists(ifile):
-        os.remove(ifile)
+    records = status_records(packages)
+    if output.format:
+        return output.emit(["package", "installed", "previous", "available",
+                            "state"], records)
+    print("%-23s %-15s %-15s %-15s %s" % \
+          ("Package", "Installed", "Previous", "Now", "State"))
+    print("="*23 + "-" + "="*15 + "-" + "="*15 + "-" + "="*15 + "-" + "="*5)
+    for name, installed, previous, available, state in records:
+        if state is None:
+            print("%-20s\t%-15s\t%-15s\t%-15s" % (name, installed, previous,
+                                                  available))
+        else:
+            print("%-20s\t%-15s\t%-15s\t%-15s\t%-2s" % (name, installed,
+                                                         previous, available,
+                                                         state))
 
 
 def do_listnames(pattern=False, pipe=False):
@@ -428,11 +1303,75 @@ def do_listnames(pattern=False, pipe=False):
 
 def do_update(simulate=False):
     if not perform.execute("apt-get update", root=True):
+        forget()
         if not simulate:
             update_available()
             print("There are {} new upgrades".format(count_upgrades()))
 
 
+def write_names(path, names):
+    """Write the set of NAMES to PATH, sorted bytewise as look(1) wants."""
+    with open(path + ".new", "w") as f:
+        f.write("".join(name + "\n" for name in sorted(set(names))))
+    os.replace(path + ".new", path)
+
+
+def refresh_completion(commands, program):
+    """Rewrite the completion indexes older than what they are made from:
+    installed and held from the dpkg status, available from the
+    Available list too, and commands (the names of wajig's COMMANDS) from
+    PROGRAM, the file defining them.
+
+    Each is a sorted list of names, so the bash completion script can
+    find those starting with a prefix by binary search, with look(1),
+    rather than by going through the dpkg status or asking apt-cache.
+
+    This runs after every command, so it first compares the modification
+    times of those files with those of the last refresh, kept in a stamp
+    file, and stops there when none moved: most commands change nothing."""
+    stamps = list()
+    for source in [dpkg_status, available_file, program]:
+        try:
+            stamps.append(str(os.stat(source).st_mtime_ns))
+        except FileNotFoundError:
+            stamps.append("-")
+    stamp = " ".join(stamps) + "\n"
+    stamp_file = os.path.join(completion_dir, "stamp")
+    try:
+        with open(stamp_file) as f:
+            if f.read() == stamp:
+                return
+    except FileNotFoundError:
+        os.makedirs(completion_dir, exist_ok=True)
+
+    def stale(name, *sources):
+        try:
+            written = os.stat(os.path.join(completion_dir, name)).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        return any(os.path.exists(source) and
+                   os.stat(source).st_mtime_ns > written
+                   for source in sources)
+
+    with tracing.span("refresh completion"):
+        if stale("installed", dpkg_status) or stale("held", dpkg_status):
+            table = selections()
+            write_names(os.path.join(completion_dir, "installed"),
+                        (selection.name for selection in select(table=table)
+                         if selection.status != "config-files"))
+            write_names(os.path.join(completion_dir, "held"),
+                        (selection.name for selection in
+                         select(want="hold", table=table)))
+        if stale("available", available_file, dpkg_status):
+            write_names(os.path.join(completion_dir, "available"),
+                        itertools.chain(read_available(available_file),
+                                        installed_versions()))
+        if stale("commands", program):
+            write_names(os.path.join(completion_dir, "commands"), commands)
+        with open(stamp_file, "w") as f:
+            f.write(stamp)
+
+
 def get_deps_recursively(cache, package, packages):
     if not package in packages:
         packages.append(package)
@@ -460,31 +1399,31 @@ def consolidate_package_names(args):
     return set(packages)
 
 
+def size_records(packages=None, size=0):
+    """Yield (package, installed size in KB, status) of PACKAGES (by
+    default all) bigger than SIZE KB, smallest first."""
+    wanted = set(packages or ())
+    sizes = dict()
+    for name, section in status_table().items():
+        installed_size = int(section.get("Installed-Size", "0"))
+        if installed_size > size and (not wanted or name in wanted):
+            sizes[name] = installed_size, section["Status"].split()[2]
+    for name in sorted(sizes, key=lambda name: sizes[name][0]):
+        yield (name,) + sizes[name]
+
+
 def sizes(packages=None, size=0):
-    status = apt_pkg.TagFile(open("/var/lib/dpkg/status", "r"))
-    size_list = dict()
-    status_list = dict()
-
-    for section in status:
-        package_name   = section.get("Package")
-        package_size   = section.get("Installed-Size")
-        package_status = re.split(" ", section.get("Status"))[2]
-        if package_size and int(package_size) > size:
-            if package_name not in size_list:
-                size_list[package_name] = package_size
-                status_list[package_name] = package_status
-
-    packages = list(size_list)
-    packages.sort(key=lambda x: int(size_list[x]))  # sort by size
-
-    if packages:
+    records = size_records(packages, size)
+    if output.format:
+        return output.emit(["package", "size", "status"], records)
+    first = next(records, None)
+    if first:
         print("{:<33} {:^10} {:>12}".format("Package", "Size (KB)", "Status"))
         print("{}-{}-{}".format("="*33, "="*10, "="*12))
-        for package in packages:
-            message = "{:<33} {:^10} {:>12}".format(package,
-                       format(int(size_list[package]), ',d'),
-                       status_list[package])
-            print(message)
+        for package, installed_size, status in itertools.chain([first],
+                                                               records):
+            print("{:<33} {:^10} {:>12}".format(package,
+                  format(installed_size, ',d'), status))
     else:
         print("No packages of >10MB size found")
 
@@ -20,24 +20,122 @@
 #
 #
 
+import tracing
+import latency
+
 import argparse
+import atexit
+import os
+import re
 import sys
 
-import commands
+with tracing.span("import commands"):
+    import commands
+import history
+import hosts
+import output
 import perform
+import util
 
 VERSION = "2.11"
 
 
-def main():
+def positive(text):
+    """A count given on the command line, which must be 1 or more."""
+    number = int(text)
+    if number < 1:
+        raise ValueError(text)
+    return number
+
+
+def pattern(text):
+    """A Python regular expression given on the command line, checked to
+    be one."""
+    try:
+        re.compile(text)
+    except re.error as error:
+        raise argparse.ArgumentTypeError(
+            "invalid pattern {!r}: {}".format(text, error))
+    return text
+
+
+def main(argv=None):
+
+    if argv is None:
+        argv = sys.argv[1:]
 
     # without arguments, run a wajig shell (interactive mode)
-    if len(sys.argv) == 1:
+    if not argv:
         import subprocess
         command = "python3 /usr/share/wajig/shell.py"
         subprocess.call(command.split())
         return
 
+    with tracing.span("argparse"):
+        result = parse(argv)
+    try:
+        result.recommends = "--install-recommends" if result.recommends else ""
+    except AttributeError:
+        pass
+    try:
+        result.local = "--no-download --ignore-missing" if result.local else ""
+    except AttributeError:
+        pass
+    try:
+        result.recommends = "--no-install-recommends" if result.norecommends else ""
+    except AttributeError:
+        pass
+    try:
+        if not result.dist:
+            result.dist = ""
+    except AttributeError:
+        pass
+    try:
+        result.noauth = " --allow-unauthenticated " if result.noauth else ""
+    except AttributeError:
+        pass
+    try:
+        result.yes = " --yes " if result.yes else ""
+    except AttributeError:
+        pass
+    output.format = result.format
+    if result.trace:
+        tracing.enable(result.trace)
+    if result.profile:
+        perform.PROFILE = True
+        atexit.register(perform.report)
+    try:
+        if result.simulate:
+            perform.SIMULATE = True
+    except AttributeError:
+        pass
+    try:
+        if result.teach:
+            perform.TEACH = True
+    except AttributeError:
+        pass
+    status = 1
+    try:
+        with tracing.span("command " + result.func.__name__):
+            result.func(result)
+        status = 0
+    except SystemExit as error:
+        status = error.code if isinstance(error.code, int) else \
+                 int(error.code is not None)
+        raise
+    finally:
+        # wajig's own status, or else that of the command it ran to change
+        # packages, e.g. apt-get failing to fetch
+        latency.record(result.func.__name__, status or perform.last_status)
+        try:
+            util.refresh_completion(result.subcommands, __file__)
+        except OSError:
+            pass  # completion falls back to reading the dpkg status
+
+
+def parse(argv):
+    """Build the command line parser, and parse ARGV with it."""
+
     parser = argparse.ArgumentParser(
         prog="wajig",
         description="unified package management front-end for Debian",
@@ -81,6 +179,19 @@ def main():
     message = "skip 'Yes/No' confirmation prompts; use with care!"
     parser_yesno.add_argument("-y", "--yes", action='store_true', help=message)
 
+    parser_orphans = argparse.ArgumentParser(add_help=False)
+    message = "look at packages of every section, not only libraries"
+    parser_orphans.add_argument("--all-sections", action="store_true",
+                                help=message)
+    message = ("look at packages of SECTION too, e.g. libdevel; wildcards "
+               "are allowed")
+    parser_orphans.add_argument("--section", action="append", help=message)
+    message = ("do not let this kind of relationship keep a package; can be "
+               "given twice")
+    parser_orphans.add_argument("--ignore", action="append",
+                                choices=["Recommends", "Suggests"],
+                                help=message)
+
     parser_auth = argparse.ArgumentParser(add_help=False)
     parser_auth.add_argument("-n", "--noauth", action='store_true',
         help="do not authenticate packages before installation")
@@ -102,10 +213,30 @@ def main():
     parser_grep.add_argument("pattern", nargs="?",
                               help="filter output, somewhat like grep")
 
+    # for the commands matching in wajig itself, rather than through grep
+    parser_regex = argparse.ArgumentParser(add_help=False)
+    parser_regex.add_argument("pattern", nargs="?", type=pattern,
+                              help="filter output by a Python regular "
+                                   "expression")
+
     message = "show wajig version"
     parser.add_argument("-V", "--version", action="version", help=message,
                         version="%(prog)s " + VERSION)
 
+    message = ("when done, show how long each external command run took, "
+               "and how much output it produced")
+    parser.add_argument("--profile", action="store_true", help=message)
+
+    message = ("write the records of list commands (listinstalled, listall, "
+               "status, sizes, toupgrade, snapshot, describe) one per line, "
+               "as they are produced, as JSON objects or tab-separated "
+               "values, instead of as text")
+    parser.add_argument("--format", choices=output.FORMATS, help=message)
+
+    message = ("write a trace of the phases of this run to TRACE (Chrome "
+               "trace format); setting $WAJIG_TRACE does the same")
+    parser.add_argument("--trace", help=message)
+
     subparsers = parser.add_subparsers(title='subcommands',
                                        help=argparse.SUPPRESS)
 
@@ -161,8 +292,13 @@ def main():
     function = commands.build
     parser_build = subparsers.add_parser("build",
                    parents=[parser_yesno, parser_auth, parser_teach],
-                   description=function.__doc__)
+                   description=function.__doc__,
+                   formatter_class=argparse.RawDescriptionHelpFormatter)
     parser_build.add_argument("packages", nargs="+")
+    parser_build.add_argument("-j", "--jobs", type=int,
+                              default=os.cpu_count() or 1,
+                              help="builds to run at a time (default: one "
+                                   "per CPU)")
     parser_build.set_defaults(func=function)
 
     function = commands.builddeps
@@ -178,7 +314,7 @@ def main():
                        parents=[parser_verbose, parser_teach],
                        description=function.__doc__,
                        formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser_changelog.add_argument("package")
+    parser_changelog.add_argument("packages", nargs="*")
     parser_changelog.set_defaults(func=function)
 
     function = commands.clean
@@ -201,6 +337,13 @@ def main():
                           description=function.__doc__)
     parser_dailyupgrade.set_defaults(func=function)
 
+    function = commands.daemon
+    parser_daemon = subparsers.add_parser("daemon",
+                    description=function.__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser_daemon.add_argument("action", choices="start stop status".split())
+    parser_daemon.set_defaults(func=function)
+
     function = commands.dependents
     parser_dependents = subparsers.add_parser("dependents",
                         description=function.__doc__,
@@ -275,6 +418,20 @@ def main():
                         description=function.__doc__)
     parser_fixmissing.set_defaults(func=function)
 
+    function = commands.fleet
+    parser_fleet = subparsers.add_parser("fleet",
+                   description=function.__doc__,
+                   formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser_fleet.add_argument("files", nargs="+",
+        help="dpkg status files or snapshots, one per host")
+    group = parser_fleet.add_mutually_exclusive_group()
+    group.add_argument("--drift", action="store_true",
+        help="only show packages that are not the same on all hosts")
+    group.add_argument("--missing", action="append", metavar="PACKAGE=VERSION",
+        type=hosts.requirement,
+        help="list hosts where PACKAGE is installed but older than VERSION")
+    parser_fleet.set_defaults(func=function)
+
     function = commands.force
     parser_force = subparsers.add_parser("force",
                    parents=[parser_teach],
@@ -349,14 +506,14 @@ def main():
     function = commands.listall
     parser_listall = subparsers.add_parser("listall",
                      aliases=["list-all"],
-                     parents=[parser_teach, parser_grep],
+                     parents=[parser_teach, parser_regex],
                      description=function.__doc__)
     parser_listall.set_defaults(func=function)
 
     function = commands.listcache
     parser_listcache = subparsers.add_parser("listcache",
                        aliases=["list-cache"],
-                       parents=[parser_teach, parser_grep],
+                       parents=[parser_teach, parser_regex],
                        description=function.__doc__)
     parser_listcache.set_defaults(func=function)
 
@@ -391,7 +548,7 @@ def main():
     function = commands.listinstalled
     parser_listinstalled = subparsers.add_parser("listinstalled",
                            aliases=["list-installed"],
-                           parents=[parser_teach, parser_grep],
+                           parents=[parser_teach, parser_regex],
                            description=function.__doc__)
     parser_listinstalled.set_defaults(func=function)
 
@@ -404,7 +561,7 @@ def main():
 
     function = commands.listpackages
     parser_listpackages = subparsers.add_parser("listpackages",
-                          parents=[parser_teach, parser_grep],
+                          parents=[parser_teach, parser_regex],
                           aliases="list list-packages".split(),
                           description=function.__doc__)
     parser_listpackages.set_defaults(func=function)
@@ -434,7 +591,7 @@ def main():
     function = commands.liststatus
     parser_liststatus = subparsers.add_parser("liststatus",
                         aliases=["list-status"],
-                        parents=[parser_teach, parser_grep],
+                        parents=[parser_teach, parser_regex],
                         description=function.__doc__)
     parser_liststatus.set_defaults(func=function)
 
@@ -445,6 +602,17 @@ def main():
     parser_madison.add_argument("packages", nargs="+")
     parser_madison.set_defaults(func=function)
 
+    function = commands.metrics
+    parser_metrics = subparsers.add_parser("metrics",
+                     description=function.__doc__,
+                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    message = ("write the metrics for the node_exporter textfile collector "
+               "to TEXTFILE, instead of showing them")
+    parser_metrics.add_argument("--textfile", help=message)
+    parser_metrics.add_argument("commands", nargs="*",
+                                help="only these commands")
+    parser_metrics.set_defaults(func=function)
+
     function = commands.move
     parser_move = subparsers.add_parser("move",
                   parents=[parser_teach],
@@ -454,7 +622,26 @@ def main():
     function = commands.new
     parser_new = subparsers.add_parser("new",
                  parents=[parser_verbose],
-                 description=function.__doc__)
+                 description=function.__doc__,
+                 formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser_new.add_argument("--limit", type=positive,
+                            help="show at most LIMIT packages")
+    parser_new.add_argument("--page", type=positive, default=1,
+                            help="with --limit, which page to show "
+                                 "(default: 1)")
+    parser_new.add_argument("--changes", nargs="*", metavar="KIND",
+                            choices=["new", "removed", "upgraded",
+                                     "downgraded"],
+                            help="show what changed at the last update, of "
+                                 "the KINDs given (new, removed, upgraded, "
+                                 "downgraded) or of all")
+    parser_new.add_argument("--since", type=history.date, metavar="DATE",
+                            help="compare with what was available on DATE "
+                                 "(YYYY-MM-DD [HH:MM]) rather than before "
+                                 "the last update")
+    parser_new.add_argument("--history", metavar="PACKAGE",
+                            help="show when each version of PACKAGE became "
+                                 "available")
     parser_new.set_defaults(func=function)
 
     function = commands.newdetail
@@ -479,11 +666,11 @@ def main():
     parser_nonfree.set_defaults(func=function)
 
     function = commands.orphans
-    parser_orphans = subparsers.add_parser("orphans",
-                     parents=[parser_teach],
-                     aliases="orphaned listorphaned listorphans".split(),
-                     description=function.__doc__)
-    parser_orphans.set_defaults(func=function)
+    parser_listorphans = subparsers.add_parser("orphans",
+                         parents=[parser_orphans],
+                         aliases="orphaned listorphaned listorphans".split(),
+                         description=function.__doc__)
+    parser_listorphans.set_defaults(func=function)
 
     function = commands.policy
     parser_policy = subparsers.add_parser("policy",
@@ -493,6 +680,16 @@ def main():
     parser_policy.add_argument("packages", nargs="+")
     parser_policy.set_defaults(func=function)
 
+    function = commands.prunecache
+    parser_prunecache = subparsers.add_parser("prunecache",
+                        aliases=["prune-cache"],
+                        parents=[parser_teach],
+                        description=function.__doc__,
+                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser_prunecache.add_argument("--keep", type=int, default=1,
+        help="how many versions of each package to keep (default: 1)")
+    parser_prunecache.set_defaults(func=function)
+
     function = commands.purge
     parser_purge = subparsers.add_parser("purge",
        aliases=["purgedepend"],
@@ -505,7 +702,7 @@ def main():
     function = commands.purgeorphans
     parser_purgeorphans = subparsers.add_parser("purgeorphans",
                           aliases=["purge-orphans"],
-                          parents=[parser_yesno],
+                          parents=[parser_yesno, parser_orphans],
                           description=function.__doc__)
     parser_purgeorphans.set_defaults(func=function)
 
@@ -519,8 +716,12 @@ def main():
     parser_rbuilddeps = subparsers.add_parser("rbuilddeps",
         parents=[parser_teach],
         aliases="rbuilddep reversebuilddeps reverse-build-deps".split(),
-        description=function.__doc__)
+        description=function.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
     parser_rbuilddeps.add_argument("package")
+    parser_rbuilddeps.add_argument("--transitive", action="store_true",
+                                   help="show every source package to "
+                                        "rebuild, round by round")
     parser_rbuilddeps.set_defaults(func=function)
 
     function = commands.readme
@@ -576,7 +777,7 @@ def main():
     function = commands.removeorphans
     parser_removeorphans = subparsers.add_parser("removeorphans",
                            aliases=["remove-orphans"],
-                           parents=[parser_yesno],
+                           parents=[parser_yesno, parser_orphans],
                            description=function.__doc__)
     parser_removeorphans.set_defaults(func=function)
 
@@ -596,6 +797,14 @@ def main():
     parser_reportbug.add_argument("package")
     parser_reportbug.set_defaults(func=function)
 
+    function = commands.restore
+    parser_restore = subparsers.add_parser("restore",
+                     aliases=["restore-snapshot"],
+                     parents=[parser_yesno, parser_auth, parser_teach],
+                     description=function.__doc__)
+    parser_restore.add_argument("snapshot")
+    parser_restore.set_defaults(func=function)
+
     function = commands.restart
     parser_restart = subparsers.add_parser("restart",
                      parents=[parser_teach],
@@ -624,7 +833,7 @@ def main():
                     parents=[parser_teach],
                     description=function.__doc__,
                     formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser_search.add_argument("patterns", nargs="+")
+    parser_search.add_argument("patterns", nargs="+", type=pattern)
     help=("'-v' will also search short package desciption; "
           "'-vv' will also search the short and long decription")
     parser_search.add_argument("-v", "--verbose", action="count", help=help)
@@ -658,9 +867,19 @@ def main():
     function = commands.snapshot
     parser_snapshot = subparsers.add_parser("snapshot",
                       parents=[parser_teach],
-                      description=function.__doc__)
+                      description=function.__doc__,
+                      formatter_class=argparse.RawDescriptionHelpFormatter)
     parser_snapshot.set_defaults(func=function)
 
+    function = commands.snapshotdiff
+    parser_snapshotdiff = subparsers.add_parser("snapshotdiff",
+                          aliases=["snapshot-diff"],
+                          description=function.__doc__,
+                          formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser_snapshotdiff.add_argument("old")
+    parser_snapshotdiff.add_argument("new", nargs="?")
+    parser_snapshotdiff.set_defaults(func=function)
+
     function = commands.source
     parser_source = subparsers.add_parser("source",
                     parents=[parser_teach],
@@ -787,6 +1006,13 @@ def main():
         description=function.__doc__)
     parser_upgrade.set_defaults(func=function)
 
+    function = commands.upgradenews
+    parser_upgradenews = subparsers.add_parser("upgradenews",
+                         aliases="upgrade-news news-upgrade".split(),
+                         description=function.__doc__,
+                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser_upgradenews.set_defaults(func=function)
+
     function = commands.upgradesecurity
     parser_upgradesecurity = subparsers.add_parser("upgradesecurity",
                              aliases=["upgrade-security"],
@@ -818,43 +1044,10 @@ def main():
     parser_whichpackage.add_argument("pattern", help="partial/full file path")
     parser_whichpackage.set_defaults(func=function)
 
-    result = parser.parse_args()
-    try:
-        result.recommends = "--install-recommends" if result.recommends else ""
-    except AttributeError:
-        pass
-    try:
-        result.local = "--no-download --ignore-missing" if result.local else ""
-    except AttributeError:
-        pass
-    try:
-        result.recommends = "--no-install-recommends" if result.norecommends else ""
-    except AttributeError:
-        pass
-    try:
-        if not result.dist:
-            result.dist = ""
-    except AttributeError:
-        pass
-    try:
-        result.noauth = " --allow-unauthenticated " if result.noauth else ""
-    except AttributeError:
-        pass
-    try:
-        result.yes = " --yes " if result.yes else ""
-    except AttributeError:
-        pass
-    try:
-        if result.simulate:
-            perform.SIMULATE = True
-    except AttributeError:
-        pass
-    try:
-        if result.teach:
-            perform.TEACH = True
-    except AttributeError:
-        pass
-    result.func(result)
+    # for the completion index; see util.refresh_completion()
+    parser.set_defaults(subcommands=sorted(subparsers.choices))
+    return parser.parse_args(argv)
+
 
 if __name__ == '__main__':
     try:
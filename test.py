@@ -3,14 +3,36 @@
 
 """Test some of wajig functionality."""
 
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
 import unittest
 import sys
 
 sys.path.append("src")
+import buildqueue
+import client
+import depgraph
+import history
+import hosts
+import latency
+import output
 import perform
+import server
+import sourcegraph
+import tracing
 import util
 
 import apt
+import apt_pkg
 
 class Tests(unittest.TestCase):
 
@@ -29,6 +51,35 @@ class Tests(unittest.TestCase):
         res = perform.execute("TEST", test=True, langC=True)
         self.assertEqual(res, "LC_ALL=C; export LC_ALL; TEST")
 
+    def test_perform_split(self):
+        self.assertEqual(perform.split("dpkg --list foo"),
+                         ["dpkg", "--list", "foo"])
+        self.assertIsNone(perform.split("dpkg --get-selections | cut -f1"))
+        self.assertIsNone(perform.split("COLUMNS=400 dpkg --list"))
+
+    def test_perform_last_status(self):
+        saved = util.start_log, util.finish_log
+        util.start_log = lambda temp: None
+        util.finish_log = os.remove
+        try:
+            self.assertEqual(perform.execute("false", log=True), 1)
+            self.assertEqual(perform.last_status, 1)
+            perform.execute("true", log=True)
+            self.assertEqual(perform.last_status, 0)
+            # only commands changing packages are wajig's to fail
+            self.assertEqual(perform.execute("false"), 1)
+            self.assertEqual(perform.last_status, 0)
+        finally:
+            util.start_log, util.finish_log = saved
+
+    def test_perform_missing(self):
+        with open(os.devnull, "w") as devnull:
+            stderr, sys.stderr = sys.stderr, devnull
+            try:
+                self.assertEqual(perform.run("no-such-command --help"), 127)
+            finally:
+                sys.stderr = stderr
+
     # ----
     # testing util.py
     # ----
@@ -44,6 +95,614 @@ class Tests(unittest.TestCase):
                               apt.package.Package)
         self.assertFalse(util.package_exists(cache, "no_such", test=True))
 
+    def test_util_session(self):
+        session = util.Session()
+        self.assertIs(session.cache, session.cache)
+        self.assertIs(session.changes(), session.changes())
+        first = session.changes()
+        session.changes(distupgrade=True)
+        # the marks of the upgrade are gone, so it is worked out again
+        self.assertIsNot(session.changes(), first)
+        self.assertEqual(session.changes(), session.cache.get_changes())
+        cache = session.cache
+        session.reset()
+        self.assertIsNot(session.cache, cache)
+
+    def test_util_describe_packages(self):
+        described = list(util.describe_packages(["dpkg", "no_such", "dpkg"]))
+        self.assertEqual([name for name, summary, description in described],
+                         ["dpkg", "no_such", "dpkg"])
+        self.assertTrue(described[0][1])
+        self.assertIsNone(described[1][1])
+
+    def test_util_search_packages(self):
+        found = util.search_packages(["^DPKG$"])
+        self.assertEqual([name for name, summary in found], ["dpkg"])
+        self.assertTrue(found[0][1])
+        self.assertEqual(util.search_packages(["^dpkg$", "no_such"]), [])
+        self.assertIn("dpkg", dict(util.search_packages(["dpkg", "debian"],
+                                                        summaries=True)))
+
+    def test_util_changelog_entries(self):
+        changelog = io.StringIO("foo (1:2.0-1) unstable; urgency=low\n"
+                                "  * two\n"
+                                "foo (1.1-1) unstable; urgency=low\n"
+                                "  * one\n"
+                                "foo (1.0-1) unstable; urgency=low\n")
+        entries = list(util.changelog_entries(changelog, since="1.1-1"))
+        self.assertEqual([version for version, lines in entries], ["1:2.0-1"])
+        self.assertEqual(len(entries[0][1]), 2)
+        # the rest of the changelog is never read
+        self.assertEqual(changelog.readline(), "  * one\n")
+
+    def test_util_read_news(self):
+        with tempfile.TemporaryDirectory() as directory:
+            root = os.path.join(directory, "foo")
+            doc = os.path.join(root, "usr", "share", "doc", "foo")
+            os.makedirs(doc)
+            os.makedirs(os.path.join(root, "DEBIAN"))
+            with open(os.path.join(root, "DEBIAN", "control"), "w") as f:
+                f.write("Package: foo\nVersion: 2.0-1\nArchitecture: all\n"
+                        "Maintainer: A <a@example.org>\n"
+                        "Description: test\n")
+            with gzip.open(os.path.join(doc, "NEWS.Debian.gz"), "wt") as f:
+                f.write("foo (2.0-1) unstable; urgency=low\n\n"
+                        "  * Big change.\n\n"
+                        "foo (1.0-1) unstable; urgency=low\n\n"
+                        "  * Old news.\n")
+            deb = os.path.join(directory, "foo_2.0-1_all.deb")
+            subprocess.check_call(["dpkg-deb", "--build", "--root-owner-group",
+                                   root, deb], stdout=subprocess.DEVNULL)
+            news = util.read_news(deb, "foo", since="1.0-1")
+            self.assertEqual(len(news), 1)
+            self.assertIn("  * Big change.\n", news[0])
+            self.assertEqual(len(util.read_news(deb, "foo")), 2)
+            self.assertEqual(util.read_news(deb, "bar"), [])
+
+    def test_util_selections(self):
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("Package: b\nStatus: hold ok installed\nVersion: 1\n"
+                    "Architecture: all\nDescription: bee\n more\n\n"
+                    "Package: c\nStatus: deinstall ok config-files\n\n"
+                    "Package: d\nStatus: purge ok not-installed\n\n"
+                    "Package: a\nStatus: hold reinstreq installed\n"
+                    "Version: 1\nMulti-Arch: same\nArchitecture: i386\n")
+            f.flush()
+            table = util.read_selections(util.read_status(f.name))
+        self.assertEqual([selection.name for selection in table],
+                         ["a:i386", "b", "c", "d"])
+        self.assertEqual(table[1].summary, "bee")
+        self.assertEqual(util.selection_flags(table[0]), "hiR")
+        held = util.select(want="hold", table=table)
+        self.assertEqual([selection.name for selection in held],
+                         ["a:i386", "b"])
+        self.assertEqual(len(util.select("^[bcd]", table=table)), 2)
+        removed = util.select(status="config-files", table=table)
+        self.assertEqual([selection.name for selection in removed], ["c"])
+
+    def test_util_set_selections(self):
+        listed = list()
+
+        def execute(command, **options):
+            path = command.rpartition("< ")[2]
+            with open(path) as f:
+                listed.append((command, f.read(), options, path))
+            return 0
+        saved = perform.execute
+        perform.execute = execute
+        try:
+            self.assertEqual(util.set_selections(["a", "b:i386"], "hold"), 0)
+        finally:
+            perform.execute = saved
+        [(command, selections, options, path)] = listed
+        self.assertEqual(selections, "a hold\nb:i386 hold\n")
+        self.assertTrue(command.startswith("dpkg --set-selections < "))
+        self.assertEqual(options, {"root": True})
+        self.assertFalse(os.path.exists(path))
+
+    def test_util_installed_instances(self):
+        native = apt_pkg.config.find("APT::Architecture")
+        with tempfile.NamedTemporaryFile("w") as f:
+            for arch, version in [(native, "1"), ("s390x", "1"),
+                                  ("all", "2")]:
+                f.write("Package: {}\nStatus: install ok installed\n"
+                        "Multi-Arch: same\nArchitecture: {}\n"
+                        "Version: {}\n\n".format("lib" + version, arch,
+                                                 version))
+            f.flush()
+            versions = util.installed_instances(util.read_status(f.name))
+        self.assertEqual(versions, {"lib1": "1", "lib1:s390x": "1",
+                                    "lib2": "2"})
+        # a host of another architecture names its own packages plainly
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("Package: dpkg\nStatus: install ok installed\n"
+                    "Architecture: s390x\nVersion: 1\n\n"
+                    "Package: lib1\nStatus: install ok installed\n"
+                    "Architecture: s390x\nVersion: 1\n")
+            f.flush()
+            versions = util.installed_instances(util.read_status(f.name))
+        self.assertEqual(versions, {"dpkg": "1", "lib1": "1"})
+
+    def test_util_archive_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ["foo_1.9_all.deb", "foo_1.10_all.deb",
+                         "foo_1%3a0.1_all.deb", "bar_2.0_amd64.deb",
+                         "partial", "lock", "odd_name.deb"]:
+                open(os.path.join(directory, name), "w").close()
+            index = util.archive_index(directory)
+        self.assertEqual(sorted(index), ["bar", "foo"])
+        self.assertEqual([archive.version for archive in index["foo"]],
+                         ["1.9", "1.10", "1:0.1"])
+        categories = [(category, archive.version) for category, archive in
+                      util.archive_categories(index, {"bar": "2.0",
+                                                      "foo": "1.10"})]
+        self.assertEqual(categories, [("installed", "2.0"),
+                                      ("superseded", "1.9"),
+                                      ("installed", "1.10"),
+                                      ("newer", "1:0.1")])
+        categories = [category for category, archive in
+                      util.archive_categories(index, {})]
+        self.assertEqual(categories, ["orphaned", "superseded", "superseded",
+                                      "orphaned"])
+        prunable = util.prunable_archives(index, 2)
+        self.assertEqual([archive.version for archive in prunable], ["1.9"])
+        self.assertEqual(util.archives_of("bar", index, "i386"), [])
+        self.assertEqual(util.archives_of("bar:amd64", index, "i386"),
+                         index["bar"])
+        self.assertEqual(len(util.archives_of("foo", index, "i386")), 3)
+        self.assertEqual(util.archives_of("baz", index), [])
+
+    def test_util_newly_available(self):
+        saved = util.new_file
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("apt\nbash\ncoreutils\ndpkg\ngrep\n")
+            f.flush()
+            util.new_file = f.name
+            try:
+                pages = list()
+                for page in range(1, 5):
+                    out = io.StringIO()
+                    with contextlib.redirect_stdout(out):
+                        util.newly_available(limit=2, page=page)
+                    pages.append(out.getvalue().splitlines()[-1])
+            finally:
+                util.new_file = saved
+        self.assertEqual(pages, ["Showing 1-2 of 5 new packages",
+                                 "Showing 3-4 of 5 new packages",
+                                 "Showing 5-5 of 5 new packages",
+                                 "No packages on page 4, of 5 new packages"])
+
+    def test_util_search_files(self):
+        saved = util.dpkg_info, util.dpkg_diversions
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "sh.list"), "w") as f:
+                f.write("/bin\n/bin/sh\n/bin/shtool\n")
+            with open(os.path.join(directory, "sh.diversions"), "w") as f:
+                f.write("/bin/sh\n/bin/sh.distrib\nsh\n")
+            util.dpkg_info = directory
+            util.dpkg_diversions = os.path.join(directory, "sh.diversions")
+            util.forget()
+            try:
+                self.assertEqual([(packages, path) for packages, path, _
+                                  in util.search_files("/bin/sh*")],
+                                 [(["sh"], "/bin/sh"), ([], "/bin/sh.distrib"),
+                                  (["sh"], "/bin/shtool")])
+                self.assertEqual(list(util.search_files("/bin/sh.distrib")),
+                                 [([], "/bin/sh.distrib",
+                                   util.Diversion("/bin/sh", "/bin/sh.distrib",
+                                                  "sh"))])
+                self.assertEqual(list(util.search_files("/bin/nope")), [])
+            finally:
+                util.dpkg_info, util.dpkg_diversions = saved
+                util.forget()
+
+    def test_util_available_versions(self):
+        with tempfile.TemporaryDirectory() as lists, \
+             tempfile.TemporaryDirectory() as cache:
+            def write(name, stanzas):
+                with open(os.path.join(lists, name), "w") as f:
+                    f.write("".join("Package: {}\nVersion: {}\n\n".format(*s)
+                                    for s in stanzas))
+            write("a_main_binary-amd64_Packages", [("foo", "1.0"),
+                                                   ("foo", "1.10"),
+                                                   ("bar", "2")])
+            write("b_main_binary-amd64_Packages", [("foo", "1.9")])
+            write("a_Release", [("ignored", "1")])
+            self.assertEqual(util.available_versions(lists, cache),
+                             {"foo": "1.10", "bar": "2"})
+            # unchanged lists are read from the cache, not parsed again
+            cached = os.path.join(cache, "a_main_binary-amd64_Packages")
+            with open(cached) as f:
+                digest = f.readline()
+            with open(cached, "w") as f:
+                f.write(digest + "baz 3\n")
+            write("b_main_binary-amd64_Packages", [("foo", "1:0.1")])
+            os.remove(os.path.join(lists, "a_Release"))
+            self.assertEqual(util.available_versions(lists, cache),
+                             {"foo": "1:0.1", "baz": "3"})
+            os.remove(os.path.join(lists, "a_main_binary-amd64_Packages"))
+            util.available_versions(lists, cache)
+            self.assertEqual(os.listdir(cache),
+                             ["b_main_binary-amd64_Packages"])
+
+    def test_util_apply_policy(self):
+        cache, policy, records = util.package_index()
+        versions = {"dpkg": "0.0", "no-such-package": "1"}
+        util.apply_policy(versions, cache, policy)
+        self.assertEqual(versions,
+                         {"dpkg": apt.Cache()["dpkg"].candidate.version,
+                          "no-such-package": "1"})
+
+    def test_util_refresh_completion(self):
+        saved = util.completion_dir
+        with tempfile.TemporaryDirectory() as directory, \
+             tempfile.NamedTemporaryFile() as program:
+            util.completion_dir = directory
+            try:
+                util.refresh_completion(["remove", "install", "add-repo"],
+                                        program.name)
+                util.refresh_completion(["changed"], program.name)
+                with open(os.path.join(directory, "commands")) as f:
+                    self.assertEqual(f.read(), "add-repo\ninstall\nremove\n")
+                later = os.stat(program.name).st_mtime_ns + 10**9
+                os.utime(program.name, ns=(later, later))
+                util.refresh_completion(["changed"], program.name)
+                with open(os.path.join(directory, "commands")) as f:
+                    self.assertEqual(f.read(), "changed\n")
+                with open(os.path.join(directory, "installed")) as f:
+                    installed = f.read().split()
+            finally:
+                util.completion_dir = saved
+        self.assertEqual(installed, sorted(installed))
+        self.assertIn("dpkg", installed)
+
+    # ----
+    # testing depgraph.py
+    # ----
+    def test_depgraph_orphans(self):
+        with tempfile.NamedTemporaryFile("w") as f:
+            f.write("Package: app\nStatus: install ok installed\n"
+                    "Section: utils\nDepends: libone | libtwo, virtual\n"
+                    "Suggests: libsuggested\n\n")
+            for name in ["libone", "libtwo", "libsuggested", "libprovider",
+                         "liborphan"]:
+                f.write("Package: {}\nStatus: install ok installed\n"
+                        "Section: libs\n".format(name))
+                if name == "libprovider":
+                    f.write("Provides: virtual\n")
+                f.write("\n")
+            f.write("Package: libgone\nStatus: deinstall ok config-files\n"
+                    "Section: libs\n")
+            f.flush()
+            graph = depgraph.Graph(util.read_status(f.name))
+        orphans = [package.name for package in graph.orphans()]
+        self.assertEqual(orphans, ["liborphan"])
+        rules = depgraph.Rules(None, ["Depends"])
+        orphans = [package.name for package in graph.orphans(rules)]
+        self.assertEqual(orphans, ["app", "liborphan", "libsuggested"])
+
+    def test_depgraph_recommended(self):
+        with tempfile.NamedTemporaryFile("w") as f:
+            for name, fields in [("app", "Recommends: extra, shared\n"),
+                                 ("tool", "Depends: shared\n"),
+                                 ("extra", "Depends: helper\n"
+                                           "Installed-Size: 10\n"),
+                                 ("helper", "Installed-Size: 5\n"),
+                                 ("shared", "")]:
+                f.write("Package: {}\nStatus: install ok installed\n{}\n"
+                        .format(name, fields))
+            f.flush()
+            graph = depgraph.Graph(util.read_status(f.name))
+        auto = {"extra", "helper", "shared"}
+        recommended = [package.name for package in graph.recommended(auto)]
+        self.assertEqual(recommended, ["extra"])
+        removed = [package.name for package in
+                   graph.reclaimable("extra", auto)]
+        self.assertEqual(removed, ["extra", "helper"])
+
+    def test_depgraph_multiarch(self):
+        native = apt_pkg.config.find("APT::Architecture")
+        with tempfile.NamedTemporaryFile("w") as f:
+            for arch in [native, "s390x"]:
+                f.write("Package: libm\nStatus: install ok installed\n"
+                        "Section: libs\nMulti-Arch: same\n"
+                        "Architecture: {}\n\n".format(arch))
+            f.write("Package: app\nStatus: install ok installed\n"
+                    "Architecture: s390x\nRecommends: libm\n\n")
+            f.flush()
+            graph = depgraph.Graph(util.read_status(f.name))
+        self.assertEqual(sorted(graph.packages),
+                         ["app:s390x", "libm:" + native, "libm:s390x"])
+        self.assertEqual(graph.orphans(), [])
+        recommended = [package.name for package in
+                       graph.recommended({"libm:s390x"})]
+        self.assertEqual(recommended, ["libm:s390x"])
+
+    # ----
+    # testing buildqueue.py
+    # ----
+    def test_buildqueue(self):
+        class Runner:
+            """Fetches sources from SOURCES, and fakes builds."""
+            def __init__(self, sources):
+                self.sources = sources
+                self.lock = threading.Lock()
+                self.running = self.most = 0
+                self.events = list()
+                # the first two builds only end once both are running
+                self.together = threading.Barrier(2, timeout=60)
+
+            def fetch(self, build):
+                shutil.copytree(os.path.join(self.sources, build.package),
+                                os.path.join(build.directory, "src"))
+                return 0
+
+            def build(self, build):
+                with self.lock:
+                    self.running += 1
+                    self.most = max(self.most, self.running)
+                    self.events.append(("start", build.package))
+                if build.package in ("libfoo", "bar"):
+                    self.together.wait()
+                with self.lock:
+                    self.running -= 1
+                    self.events.append(("end", build.package))
+                if build.package == "broken":
+                    return 1
+                for binary in build.binaries:
+                    open(os.path.join(build.directory,
+                                      binary + "_1_all.deb"), "w").close()
+                return 0
+
+            def install(self, debs):
+                self.events.append(("install", sorted(
+                    os.path.basename(deb) for deb in debs), self.running))
+                return 0
+
+        # trivial source packages: libfoo <- foo <- foo-extra, bar alone,
+        # and baz needing broken
+        packages = {"libfoo": ("libfoo1, libfoo-dev", ""),
+                    "foo": ("foo", "debhelper-compat (= 13), libfoo-dev"),
+                    "foo-extra": ("foo-extra", "foo [amd64]"),
+                    "bar": ("bar", "debhelper-compat (= 13)"),
+                    "broken": ("broken-dev", ""),
+                    "baz": ("baz", "broken-dev | other-dev")}
+        with tempfile.TemporaryDirectory() as sources, \
+             tempfile.TemporaryDirectory() as workdir:
+            for package, (binaries, depends) in packages.items():
+                os.makedirs(os.path.join(sources, package, "debian"))
+                with open(os.path.join(sources, package, "debian",
+                                       "control"), "w") as f:
+                    f.write("Source: {}\nBuild-Depends: {}\n".format(
+                            package, depends))
+                    for binary in binaries.split(", "):
+                        f.write("\nPackage: {}\n".format(binary))
+            runner = Runner(sources)
+            queue = buildqueue.Queue(packages, workdir, runner, jobs=2)
+            queue.fetch()
+            self.assertEqual(queue.archive_relations(),
+                             ["build-essential", "debhelper-compat (= 13)",
+                              "debhelper-compat (= 13)"])
+            builds = {build.package: build for build in queue.run()}
+        self.assertEqual({package: build.status
+                          for package, build in builds.items()},
+                         {"libfoo": "built", "foo": "built",
+                          "foo-extra": "built", "bar": "built",
+                          "broken": "build failed", "baz": "skipped"})
+        events = runner.events
+        # only what foo build-depends on is installed for it, and only
+        # while nothing is being built
+        self.assertLess(events.index(("end", "libfoo")),
+                        events.index(("install", ["libfoo-dev_1_all.deb"],
+                                      0)))
+        self.assertEqual([event[2] for event in events
+                          if event[0] == "install"], [0, 0])
+        self.assertLess(events.index(("end", "foo")),
+                        events.index(("start", "foo-extra")))
+        self.assertEqual(runner.most, 2)
+        self.assertIn("build", builds["bar"].seconds)
+
+    # ----
+    # testing hosts.py
+    # ----
+    def test_hosts_compare(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "one.status"), "w") as f:
+                f.write("Package: a\nStatus: install ok installed\n"
+                        "Version: 1.0\n\n"
+                        "Package: b\nStatus: deinstall ok config-files\n"
+                        "Version: 2.0\n")
+            with open(os.path.join(directory, "two.snapshot"), "w") as f:
+                f.write("a=1.1\nb=2.0\n")
+            fleet = hosts.read([directory])
+        self.assertEqual(fleet, {"one": {"a": "1.0"},
+                                 "two": {"a": "1.1", "b": "2.0"}})
+        drift = dict(hosts.drift(fleet))
+        self.assertEqual(drift["a"], {"1.0": ["one"], "1.1": ["two"]})
+        self.assertEqual(drift["b"], {None: ["one"], "2.0": ["two"]})
+        self.assertEqual(hosts.missing(fleet, "a", "1.1"), ["one"])
+        self.assertEqual(hosts.requirement("a=1:1.0=x"), ("a", "1:1.0=x"))
+        self.assertRaises(ValueError, hosts.requirement, "a")
+
+    def test_hosts_snapshot_diff(self):
+        old = {"a": "1.0", "b": "2.0", "c": "1:0.5"}
+        new = {"b": "2.0", "c": "1.0", "d": "0.1"}
+        changes = list(util.version_changes(old, new))
+        self.assertEqual(changes, [("a", "1.0", None, "remove"),
+                                   ("c", "1:0.5", "1.0", "downgrade"),
+                                   ("d", None, "0.1", "install")])
+        with tempfile.NamedTemporaryFile("r") as f:
+            util.write_delta(changes, f.name)
+            self.assertEqual(list(util.read_delta(f.name)),
+                             [("removed", "a", "1.0", None),
+                              ("downgraded", "c", "1:0.5", "1.0"),
+                              ("new", "d", None, "0.1")])
+            self.assertEqual(len(list(util.read_delta(f.name, ["new"]))), 1)
+        snapshot = io.StringIO()
+        hosts.write_snapshot(new, snapshot)
+        self.assertTrue(snapshot.getvalue().startswith(hosts.SNAPSHOT_HEADER))
+
+    # ----
+    # testing history.py
+    # ----
+    def test_history(self):
+        tables = [{"a": "1", "b": "1"}, {"a": "2", "b": "1"}, {"a": "2"},
+                  {"a": "2", "c": "1"}, {"a": "2", "c": "1"},
+                  {"a": "3", "b": "2", "c": "1"}]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "History")
+            self.assertIsNone(history.start(path))
+            previous = dict()
+            for i, table in enumerate(tables):
+                history.record(previous, table, path, when=1000 + 10 * i)
+                previous = table
+            kinds = [entry.kind for entry in history.read_index(path)]
+            self.assertEqual(kinds, ["checkpoint", "delta", "checkpoint",
+                                     "delta", "delta"])
+            for i, table in enumerate(tables):
+                self.assertEqual(history.table_at(1005 + 10 * i, path), table)
+            self.assertIsNone(history.table_at(999, path))
+            self.assertEqual(history.start(path), 1000)
+            self.assertEqual(list(history.versions("b", path)),
+                             [(1000, "1"), (1020, None), (1050, "2")])
+
+    # ----
+    # testing sourcegraph.py
+    # ----
+    def test_sourcegraph(self):
+        sources = [("openssl", "libssl3, libssl-dev, openssl",
+                    "Build-Depends: debhelper-compat (= 13), perl:any\n"),
+                   ("curl", "libcurl4, curl",
+                    "Build-Depends-Arch: libssl-dev [!hurd-i386] <!nossl>\n"),
+                   ("git", "git", "Build-Depends: libcurl4-gnutls-dev | "
+                    "libcurl4-openssl-dev\nBuild-Depends-Indep: curl\n"),
+                   ("openssl", "libssl3", "Build-Depends: zlib1g-dev\n")]
+        with tempfile.TemporaryDirectory() as lists, \
+             tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(lists, "a_main_source_Sources"), "w") as f:
+                for source, binaries, depends in sources:
+                    f.write("Package: {}\nBinary: {}\n{}\n".format(
+                            source, binaries, depends))
+            cache = os.path.join(directory, "Sources")
+            for i in range(2):  # parsed, then read back from the cache
+                graph = sourcegraph.Graph(cache, lists)
+                self.assertEqual(graph.rdepends("libssl-dev"), ["curl"])
+                self.assertEqual(graph.rdepends("libcurl4-openssl-dev"),
+                                 ["git"])
+                self.assertEqual(graph.rdepends("zlib1g-dev"), ["openssl"])
+                self.assertEqual(graph.rebuilds("perl"),
+                                 [("openssl", 1), ("curl", 2), ("git", 3)])
+
+    # ----
+    # testing latency.py
+    # ----
+    def test_latency_summary(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = os.path.join(directory, "Metrics")
+            with open(store, "w") as f:
+                f.write(latency.STORE_HEADER)
+                for second in range(1, 21):
+                    f.write("{}\tupdate\t{}\t0\t1000\t0\n".format(second,
+                                                                      second))
+                f.write("30\tupgrade\t5.0\t3\t0\t100\n30\tupgr")
+            summaries = latency.summarize(latency.read(store))
+            textfile = os.path.join(directory, "wajig.prom")
+            latency.write_textfile(summaries, textfile)
+            with open(textfile) as f:
+                exported = f.read()
+        update = summaries["update"]
+        self.assertEqual((update.runs, update.p50, update.p95, update.max),
+                         (20, 10.0, 19.0, 20.0))
+        self.assertEqual(update.downloaded, 20000)
+        self.assertEqual(summaries["upgrade"].failures, 1)
+        self.assertIn('wajig_command_duration_seconds{command="update",'
+                      'quantile="0.95"} 19.0\n', exported)
+        self.assertIn('wajig_command_last_exit_status{command="upgrade"} 100\n',
+                      exported)
+
+    # ----
+    # testing tracing.py
+    # ----
+    def test_tracing(self):
+        with tempfile.NamedTemporaryFile("r") as f:
+            tracing.restart(f.name)
+            with tracing.span("outer"):
+                with tracing.span("inner", detail=1):
+                    pass
+            tracing.write()
+            tracing.enable(None)
+            trace = json.load(f)
+        names = [event["name"] for event in trace["traceEvents"]]
+        self.assertEqual(names[1:], ["inner", "outer"])
+        inner, outer = trace["traceEvents"][1:]
+        self.assertEqual(inner["args"]["detail"], 1)
+        self.assertIn("peak_rss_kb", inner["args"])
+        self.assertLessEqual(outer["ts"], inner["ts"])
+        self.assertGreaterEqual(outer["ts"] + outer["dur"],
+                                inner["ts"] + inner["dur"])
+
+    # ----
+    # testing output.py
+    # ----
+    def test_output_emit(self):
+        records = [("bash", "GNU\tBourne\nAgain"), ("dash", None)]
+        try:
+            for format in output.FORMATS:
+                output.format = format
+                out = io.StringIO()
+                output.emit(["package", "summary"], iter(records), out)
+                if format == "tsv":
+                    self.assertEqual(out.getvalue(), "package\tsummary\n"
+                                     "bash\tGNU\\tBourne\\nAgain\n"
+                                     "dash\t\n")
+                else:
+                    lines = out.getvalue().splitlines()
+                    self.assertEqual([json.loads(line) for line in lines],
+                                     [{"package": "bash",
+                                       "summary": "GNU\tBourne\nAgain"},
+                                      {"package": "dash", "summary": None}])
+        finally:
+            output.format = None
+
+    # ----
+    # testing server.py
+    # ----
+    def test_server_round_trip(self):
+        saved = server.socket_path, client.socket_path
+        with tempfile.TemporaryDirectory() as directory, \
+             tempfile.TemporaryFile("w+") as out:
+            server.socket_path = os.path.join(directory, "Daemon")
+            client.socket_path = lambda: server.socket_path
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    null = os.open(os.devnull, os.O_WRONLY)
+                    os.dup2(null, 1)
+                    os.dup2(null, 2)
+                    server.serve()
+                finally:
+                    os._exit(0)
+            saved_stdout = os.dup(1)
+            sys.stdout.flush()
+            os.dup2(out.fileno(), 1)
+            try:
+                # None until the service has loaded and is listening
+                deadline = time.monotonic() + 120
+                status = None
+                while status is None and time.monotonic() < deadline:
+                    status = client.request(["whichpackage", "/usr/bin/dpkg"])
+                unserved = client.request(["install", "dpkg"])
+            finally:
+                os.dup2(saved_stdout, 1)
+                os.close(saved_stdout)
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+                server.socket_path, client.socket_path = saved
+            out.seek(0)
+            self.assertEqual(status, 0)
+            self.assertEqual(out.read(), "dpkg: /usr/bin/dpkg\n")
+            self.assertEqual(unserved, 2)
+
 
 if __name__ == '__main__':
     unittest.main()
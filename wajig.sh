@@ -1,3 +1,7 @@
 #!/bin/sh
 
+# Hand over to 'wajig daemon' when it's running; see src/client.py
+if [ -S "$HOME/.wajig/$(hostname)/Daemon" ]; then
+    exec python3 /usr/share/wajig/client.py "$@"
+fi
 /usr/share/wajig/wajig.py "$@"